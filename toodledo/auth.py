@@ -0,0 +1,161 @@
+"""
+Authorization with the ToodleDo API: getting the tokens from scratch (interactively), refreshing
+and saving them. OAuth2Session is only needed to authorize from scratch, so it is imported then.
+"""
+import os
+import json
+import logging
+import urllib.parse
+import client
+
+CUR_FILE_DIR = os.path.dirname(os.path.realpath(__file__))+os.path.sep
+AUTHORIZATION_URL = "https://api.toodledo.com/3/account/authorize.php"
+TOKEN_URL = 'https://api.toodledo.com/3/account/token.php'
+TOKEN_FILENAME = CUR_FILE_DIR+"token.txt"
+CLIENT_ID_FIELD = 'CLIENT_ID'
+CLIENT_SECRET_FIELD = 'CLIENT_SECRET'
+REDIRECT_URL_FIELD = 'REDIRECT_URL'
+ALL_SCOPES = ["basic","folders", "tasks","notes","outlines","lists"]
+# Restoring needs to add items too
+WRITE_SCOPES = ALL_SCOPES+["write"]
+# Authorization from scratch asks the user for the callback URL at most this many times
+MAX_AUTHORIZATION_ATTEMPTS = 3
+
+
+def get_token_response(request_body):
+    access_token, refresh_token = None, None
+    # Authorization codes and refresh tokens are single-use: a retry after a lost response would fail
+    token_response = client.post(TOKEN_URL, request_body, idempotent=False, refresh_on_401=False)
+    if token_response.status_code == 200:
+        token_dict = json.loads(token_response.text)
+        if "access_token" in token_dict:
+            access_token = token_dict["access_token"]
+        if "refresh_token" in token_dict:
+            refresh_token = token_dict["refresh_token"]
+    else:
+        logging.warning("Failed to refresh. Status: %d. Result:\n%s",
+                token_response.status_code, str(token_response.text))
+    return access_token, refresh_token
+
+
+def get_authorization_response(config, oauth):
+    authorization_url, state = oauth.authorization_url(AUTHORIZATION_URL)
+    # Here print is intended. We are working with console.
+    print('Please go to thir URL and authorize access:')
+    print(authorization_url)
+    authorization_response = input('Enter the full callback URL: ')
+    return authorization_response
+
+
+def refresh_tokens(config, access_token, refresh_token):
+    # If failed to refresh, we'll be OK anyway
+    body = {'client_id': config[CLIENT_ID_FIELD],
+            'client_secret': config[CLIENT_SECRET_FIELD],
+            'redirect_uri': config[REDIRECT_URL_FIELD],
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+    }
+    try:
+        new_access_token, new_refresh_token = get_token_response(body)
+        if new_access_token is None:
+            new_access_token = access_token
+            logging.info("Keeping old access token: %s", new_access_token)
+        else:
+            logging.info("New access token: %s", new_access_token)
+
+        if new_refresh_token is None:
+            new_refresh_token = refresh_token
+            logging.info("Keeping old refresh token: %s", new_refresh_token)
+        else:
+            logging.info("New refresh token: %s", new_refresh_token)
+    except Exception as e:
+        logging.warning("Failed to refresh. Might still be OK with old token.", str(e))
+        new_access_token, new_refresh_token = access_token, refresh_token
+    return new_access_token, new_refresh_token
+
+
+def get_tokens_from_scratch(config, scopes=ALL_SCOPES):
+    from requests_oauthlib import OAuth2Session
+    oauth = OAuth2Session(config[CLIENT_ID_FIELD],
+            redirect_uri=config[REDIRECT_URL_FIELD],
+            scope=scopes)
+    authorization_response = get_authorization_response(config, oauth)
+
+    connection_success=False
+    first_time = True
+    attempts = 0
+    while not connection_success:
+        if attempts >= MAX_AUTHORIZATION_ATTEMPTS:
+            raise RuntimeError("Failed to get the tokens in %d attempts" % attempts)
+        attempts += 1
+        try:
+            if not first_time:
+                logging.info("Trying to reconnect...")
+                authorization_response = get_authorization_response(config, oauth)
+            first_time = False
+            code = urllib.parse.parse_qs(
+                urllib.parse.urlsplit(authorization_response).query
+            )["code"][0]
+            # Just could not get in OAuth. It kept throwing
+            # "(missing_token) Missing access token parameter"
+            # Well, let's just get it working manually then.
+            body = {'client_id': config[CLIENT_ID_FIELD],
+                    'client_secret': config[CLIENT_SECRET_FIELD],
+                    'code': code,
+                    'redirect_uri': config[REDIRECT_URL_FIELD],
+                    'grant_type': 'authorization_code',
+                    'authorization_response': authorization_response,
+            }
+            access_token, refresh_token = get_token_response(body)
+            connection_success = (access_token is not None)and(refresh_token is not None)
+        except Exception as e:
+            logging.warning("Token fetch failed: %s", str(e))
+    return access_token, refresh_token
+
+
+def make_token_refresher(config, refresh_token, token_filename=TOKEN_FILENAME):
+    """
+    Returns the function the API client calls on 401 to get a fresh access token.
+    The refreshed tokens are saved right away.
+    """
+    tokens = {"refresh": refresh_token}
+
+    def refresh(access_token):
+        new_access_token, tokens["refresh"] = refresh_tokens(config, access_token, tokens["refresh"])
+        save_tokens(new_access_token, tokens["refresh"], token_filename)
+        return new_access_token
+    return refresh
+
+
+def save_tokens(access_token, refresh_token, token_filename=TOKEN_FILENAME):
+    with open(token_filename,"wt") as f:
+        f.write(access_token+"\n"+refresh_token)
+    logging.info("Saved tokens")
+
+
+def get_tokens(config, token_filename=TOKEN_FILENAME, scopes=ALL_SCOPES, interactive=True, refresh=True):
+    """
+    Tokens from the file, refreshed unless refresh is off (an expired access token is refreshed
+    by the client anyway). Without them, authorizes from scratch unless interactive is off.
+    """
+    access_token = None
+    refresh_token = None
+    if os.path.isfile(token_filename):
+        with open(token_filename,"rt") as f:
+            s = f.read().split('\n')
+            if len(s) == 2:
+                access_token, refresh_token = s[0], s[1]
+                logging.info("Access token from file: %s", access_token)
+                logging.info("Refresh token from file: %s",refresh_token)
+                if refresh:
+                    access_token, refresh_token = refresh_tokens(config, access_token, refresh_token)
+
+    if access_token is None or refresh_token is None:
+        if not interactive:
+            raise RuntimeError("No tokens in %s. Authorize the account first." % token_filename)
+        access_token, refresh_token = get_tokens_from_scratch(config, scopes)
+
+    logging.info("Obtained tokens successfully")
+    logging.info("Final access token: %s", access_token)
+    logging.info("Final refresh token: %s",refresh_token)
+    return access_token, refresh_token
@@ -3,25 +3,35 @@ Backs up ToodleDo
 """
 import sys
 import os
-import requests
-import yaml
+import numpy as np
 import pandas as pd
-from getpass import getpass
-from requests_oauthlib import OAuth2Session
-import requests
-import urllib
 import json
+import codecs
 import logging
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import client
+from auth import TOKEN_FILENAME, get_tokens, save_tokens, make_token_refresher
+import metrics
+from storage import save_table, read_table, table_exists, remove_table, delta_filename, \
+    make_schema, merge_delta_table, TableWriter
+import storage
+import snapshots
+import run_journal
+import diff_backups
+import reference_cache
+from reference_cache import build_name_index
 
 # TODO modify redirection URI? Localhost is a bit weird, there might be something running there.
 # So, just play around with possibilities and see what works.
 # TODO create a dummy user account and try to restore info there
-# TODO Add writing scope
 # TODO Commons with constants? Make sure the script is runnable form anywhere
 
 CUR_FILE_DIR = os.path.dirname(os.path.realpath(__file__))+os.path.sep
 API_URL_PREFIX = "http://api.toodledo.com/3/"
 GET_URL_POSTFIX = '/get.php'
+DELETED_URL_POSTFIX = '/deleted.php'
 
 # Tasks: http://api.toodledo.com/3/tasks/index.php
 DEFAULT_TASK_FIELDS = ["id", "title", "modified", "completed"]
@@ -37,131 +47,224 @@ DEFAULT_LOCATION_FIELDS = ["id","name","description","lat","lon"]
 DEFAULT_NOTES_FIELDS = ["id","title","modified","added","folder","private","text"]
 LIST_ROW_DEFAULT_FIELDS=["id","added","modified","version","list","cells"]
 LIST_COL_DEFAULT_FIELDS=["id","title","type","sort","width"]
+LIST_DEFAULT_FIELDS = ["id","added","modified","title","version","note","keywords","rows"]
+LIST_CELL_FIELDS = ["value","row_id","column_ids"]
+# Files of every list in the Lists folder: rows, columns and cells
+LIST_ITEM_PREFIXES = ["rows_list_", "cols_list_", "cells_list_"]
+OUTLINE_DEFAULT_FIELDS = ["id","added","modified","title","hidden","version","note","keywords","count","updated_at"]
+
+# Field types for the typed (Parquet) backups. The rest of the fields are text.
+INTEGER_FIELDS = ["id", "modified", "completed", "added", "folder", "context", "goal", "location",
+        "startdate", "duedate", "duedatemod", "starttime", "duetime", "remind", "status", "star",
+        "priority", "length", "timer", "parent", "children", "order", "previous", "private",
+        "archived", "ord", "level", "contributes", "version", "list", "rows", "sort", "width",
+        "hidden", "count", "updated_at", "list_id", "row_id", "column_ids", "outline_id"]
+FLOAT_FIELDS = ["lat", "lon"]
+SCHEMAS = {
+    "tasks": make_schema(DEFAULT_TASK_FIELDS+OPTIONAL_TASK_FIELDS, INTEGER_FIELDS, FLOAT_FIELDS),
+    "folders": make_schema(DEFAULT_FOLDER_FIELDS, INTEGER_FIELDS, FLOAT_FIELDS),
+    "contexts": make_schema(DEFAULT_CONTEXT_FIELDS, INTEGER_FIELDS, FLOAT_FIELDS),
+    "goals": make_schema(DEFAULT_GOAL_FIELDS, INTEGER_FIELDS, FLOAT_FIELDS),
+    "locations": make_schema(DEFAULT_LOCATION_FIELDS, INTEGER_FIELDS, FLOAT_FIELDS),
+    "notes": make_schema(DEFAULT_NOTES_FIELDS, INTEGER_FIELDS, FLOAT_FIELDS),
+    "lists": make_schema(LIST_DEFAULT_FIELDS, INTEGER_FIELDS, FLOAT_FIELDS),
+    "rows": make_schema(LIST_ROW_DEFAULT_FIELDS+["list_id"], INTEGER_FIELDS, FLOAT_FIELDS),
+    "cols": make_schema(LIST_COL_DEFAULT_FIELDS+["list_id"], INTEGER_FIELDS, FLOAT_FIELDS),
+    "cells": make_schema(LIST_CELL_FIELDS+["list_id"], INTEGER_FIELDS, FLOAT_FIELDS),
+    "outlines": make_schema(OUTLINE_DEFAULT_FIELDS, INTEGER_FIELDS, FLOAT_FIELDS),
+    # Outline nodes have text ids and nested children
+    "outline_rows": make_schema(["outline_id"], INTEGER_FIELDS, FLOAT_FIELDS),
+}
 
 
-AUTHORIZATION_URL = "https://api.toodledo.com/3/account/authorize.php"
-TOKEN_URL = 'https://api.toodledo.com/3/account/token.php'
-TOKEN_FILENAME = CUR_FILE_DIR+"token.txt"
 CONFIG_FILENAME = CUR_FILE_DIR+"config.yaml"
-CLIENT_ID_FIELD = 'CLIENT_ID'
-CLIENT_SECRET_FIELD = 'CLIENT_SECRET'
-REDIRECT_URL_FIELD = 'REDIRECT_URL'
 BACKUP_FOLDER_FIELD = 'BACKUP_FOLDER'
-ALL_SCOPES = ["basic","folders", "tasks","notes","outlines","lists"]
-
-
-def get_token_response(request_body):
-    access_token, refresh_token = None, None
-    token_response = requests.post(TOKEN_URL, data = request_body)
-    if token_response.status_code == 200:
-        token_dict = json.loads(token_response.text)
-        if "access_token" in token_dict:
-            access_token = token_dict["access_token"]
-        if "refresh_token" in token_dict:
-            refresh_token = token_dict["refresh_token"]
+TASKS_PAGE_SIZE_FIELD = 'TASKS_PAGE_SIZE'
+INCREMENTAL_FIELD = 'INCREMENTAL'
+MAX_CONCURRENT_REQUESTS_FIELD = 'MAX_CONCURRENT_REQUESTS'
+MAX_RETRIES_FIELD = 'MAX_RETRIES'
+REQUESTS_PER_HOUR_FIELD = 'REQUESTS_PER_HOUR'
+BACKUP_FORMATS_FIELD = 'BACKUP_FORMATS'
+SNAPSHOTS_FIELD = 'SNAPSHOTS'
+RUN_REPORT_FIELD = 'RUN_REPORT'
+PROMETHEUS_TEXTFILE_FIELD = 'PROMETHEUS_TEXTFILE'
+RESUME_FIELD = 'RESUME'
+REFERENCE_CACHE_FIELD = 'REFERENCE_CACHE'
+
+# tasks/get.php returns at most 1000 tasks per request
+DEFAULT_TASKS_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 64*1024
+
+# Last seen "modified" stamp of every entity, kept in the backup folder for incremental runs
+SYNC_STATE_FILENAME = 'sync_state.json'
+# Changes made in the same second as the last seen one might have been missed by the previous run.
+# Fetching them once more is harmless: merging is idempotent.
+AFTER_OVERLAP_SECONDS = 1
+# Run metrics, in the backup folder unless the path is absolute
+DEFAULT_RUN_REPORT = 'run_report.json'
+
+# Stages that fetch an entity, i.e. everything but the merge and the snapshot
+ENTITIES = ["tasks", "folders", "contexts", "goals", "locations", "notes", "lists", "outlines"]
+REFERENCE_TABLES = ["folders", "contexts", "goals", "locations"]
+# Tables written by the stages, relative to the backup folder. The first one is the result of the stage.
+STAGE_TABLES = {
+    "tasks": ['raw_tasks.csv'],
+    "folders": ['folders.csv'],
+    "contexts": ['contexts.csv'],
+    "goals": ['goals.csv'],
+    "locations": ['locations.csv'],
+    "notes": ['notes.csv'],
+    "lists": ['lists.csv', 'lists_rows.csv', 'lists_cols.csv', 'lists_cells.csv'],
+    "outlines": ['outlines.csv', 'outlines_rows.csv'],
+    "merge": ['tasks.csv'],
+    "snapshot": [],
+}
+sync_state_lock = threading.Lock()
+
+
+def run_stage(name, stage):
+    with metrics.Stage(name):
+        return stage()
+
+
+def run_journaled(journal, name, backup_path, stage, sync_state=None):
+    """
+    Runs the stage unless the interrupted run (per the journal) has finished it already,
+    in which case its result is None: the tables it saved are read from the backup folder
+    by whoever needs them. The sync state is saved
+    as soon as the stage is done, so a resumed run does not fetch the same changes again.
+    A stage that failed some of its fetches is not finished, the resumed run runs it again.
+    """
+    filenames = [backup_path+i for i in STAGE_TABLES[name]]
+    if journal.stage_done(name):
+        logging.info("Stage %s was finished by the interrupted run. Skipping it.", name)
+        return None
+    result = stage()
+    if metrics.has_failures(name):
+        # Its files are those of the previous run: a resumed run must fetch it again
+        logging.warning("Stage %s failed to fetch some of its items. Not recording it as finished.", name)
     else:
-        logging.warning("Failed to refresh. Status: %d. Result:\n%s",
-                token_response.status_code, str(token_response.text))
-    return access_token, refresh_token
-
-
-def get_authorization_response(config, oauth):
-    authorization_url, state = oauth.authorization_url(AUTHORIZATION_URL)
-    # Here print is intended. We are working with console.
-    print('Please go to thir URL and authorize access:')
-    print(authorization_url)
-    authorization_response = input('Enter the full callback URL: ')
-    return authorization_response
-
-
-def refresh_tokens(config, access_token, refresh_token):
-    # If failed to refresh, we'll be OK anyway
-    body = {'client_id': config[CLIENT_ID_FIELD],
-            'client_secret': config[CLIENT_SECRET_FIELD],
-            'redirect_uri': config[REDIRECT_URL_FIELD],
-            'grant_type': 'refresh_token',
-            'refresh_token': refresh_token,
-    }
-    try:
-        new_access_token, new_refresh_token = get_token_response(body)
-        if new_access_token is None:
-            new_access_token = access_token
-            logging.info("Keeping old access token: %s", new_access_token)
-        else:
-            logging.info("New access token: %s", new_access_token)
+        journal.finish_stage(name, filenames)
+    if sync_state is not None:
+        save_sync_state(backup_path, sync_state)
+    return result
+
+
+def run_concurrently(stages: dict, max_workers: int=None):
+    """
+    Runs the independent stages (name -> function without arguments) in a thread pool.
+    Returns name -> result. A failed stage is logged and its result is None.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1) as executor:
+        futures = {name: executor.submit(run_stage, name, stages[name]) for name in stages}
+        for name in futures:
+            try:
+                results[name] = futures[name].result()
+            except Exception as e:
+                logging.warning("Stage %s failed: %s", name, str(e))
+                results[name] = None
+    return results
+
+
+def get_backup_path(config):
+    return os.path.normpath(("" if os.path.isabs(config[BACKUP_FOLDER_FIELD]) else CUR_FILE_DIR)
+            + config[BACKUP_FOLDER_FIELD]) + os.path.sep
 
-        if new_refresh_token is None:
-            new_refresh_token = refresh_token
-            logging.info("Keeping old refresh token: %s", new_refresh_token)
+
+def configure_client(config, refresh_token, token_filename=TOKEN_FILENAME):
+    client.configure(
+        max_concurrent=config.get(MAX_CONCURRENT_REQUESTS_FIELD, client.DEFAULT_MAX_CONCURRENT_REQUESTS),
+        retries=config.get(MAX_RETRIES_FIELD, client.DEFAULT_MAX_RETRIES),
+        requests_per_hour=config.get(REQUESTS_PER_HOUR_FIELD, client.DEFAULT_REQUESTS_PER_HOUR),
+        refresher=make_token_refresher(config, refresh_token, token_filename))
+
+
+def load_sync_state(backup_path):
+    state_filename = backup_path+SYNC_STATE_FILENAME
+    if not os.path.isfile(state_filename):
+        logging.info("No sync state found. Doing full backup.")
+        return {}
+    with open(state_filename, "rt") as f:
+        return json.load(f)
+
+
+def save_sync_state(backup_path, sync_state):
+    # Stages save it as they finish, possibly at the same time
+    with sync_state_lock:
+        storage.write_atomically(backup_path+SYNC_STATE_FILENAME, json.dumps(dict(sync_state), indent=2))
+    logging.info("Saved sync state: %s", sync_state)
+
+
+def get_deleted_items(access_token, parameter_name, after, url_additions={}):
+    """
+    Returns the list of {"id": ..., "stamp": ...} for the items deleted after the timestamp,
+    or None if the request failed.
+    """
+    url = API_URL_PREFIX + parameter_name + DELETED_URL_POSTFIX
+    data = {'access_token': access_token, 'after': after}
+    for i in url_additions:
+        data[i] = url_additions[i]
+    try:
+        response = client.post(url, data)
+        if response.status_code == 200:
+            result_json_parsed = json.loads(response.text)
+            if type(result_json_parsed) == list:
+                # The first element is num
+                deleted = [i for i in result_json_parsed if "id" in i]
+                logging.info("%d %s deleted since %d", len(deleted), parameter_name, after)
+                return deleted
+            logging.warning("Failed to read deleted %s. Response body: %s",
+                    parameter_name, result_json_parsed)
         else:
-            logging.info("New refresh token: %s", new_refresh_token)
+            logging.warning(
+                "Failed to read deleted %s. Response status code: %d.\n Detailed response: %s",
+                parameter_name, response.status_code, str(response.text))
     except Exception as e:
-        logging.warning("Failed to refresh. Might still be OK with old token.", str(e))
-        new_access_token, new_refresh_token = access_token, refresh_token
-    return new_access_token, new_refresh_token
-
+        logging.warning("Failed to list deleted %s: %s", parameter_name, str(e))
+    return None
 
-def get_tokens_from_scratch(config):
-    oauth = OAuth2Session(config[CLIENT_ID_FIELD],
-            redirect_uri=config[REDIRECT_URL_FIELD],
-            scope=ALL_SCOPES)
-    authorization_response = get_authorization_response(config, oauth)
 
-    connection_success=False
-    first_time = True
-    while not connection_success:
-        try:
-            if not first_time:
-                logging.info("Trying to reconnect...")
-                authorization_response = get_authorization_response(config, oauth)
-            first_time = False
-            code = urllib.parse.parse_qs(
-                urllib.parse.urlsplit(authorization_response).query
-            )["code"][0]
-            # Just could not get in OAuth. It kept throwing
-            # "(missing_token) Missing access token parameter"
-            # Well, let's just get it working manually then.
-            body = {'client_id': config[CLIENT_ID_FIELD],
-                    'client_secret': config[CLIENT_SECRET_FIELD],
-                    'code': code,
-                    'redirect_uri': config[REDIRECT_URL_FIELD],
-                    'grant_type': 'authorization_code',
-                    'authorization_response': authorization_response,
-            }
-            access_token, refresh_token = get_token_response(body)
-            connection_success = (access_token is not None)and(refresh_token is not None)
-        except Exception as e:
-            logging.warning("Token fetch failed: %s", str(e))
-            # TODO prevent infinite loop here? Prompt after error?
-            # Limit the number of retries? Parametrize?
-    return access_token, refresh_token
+def get_account_info(access_token):
+    """
+    The account info of account/get.php: user id, last edit stamps of the items, etc.
+    None if the request failed.
+    """
+    url = API_URL_PREFIX + "account" + GET_URL_POSTFIX
+    try:
+        response = client.post(url, {'access_token': access_token})
+        if response.status_code == 200:
+            result_json_parsed = json.loads(response.text)
+            if type(result_json_parsed) == dict and "userid" in result_json_parsed:
+                return result_json_parsed
+            logging.warning("Failed to read the account info. Response body: %s", result_json_parsed)
+        else:
+            logging.warning(
+                "Failed to read the account info. Response status code: %d.\n Detailed response: %s",
+                response.status_code, str(response.text))
+    except Exception as e:
+        logging.warning("Failed to read the account info: %s", str(e))
+    return None
 
 
-def save_tokens(access_token, refresh_token):
-    with open(TOKEN_FILENAME,"wt") as f:
-        f.write(access_token+"\n"+refresh_token)
-    logging.info("Saved tokens")
+def latest_stamp(values, deleted_items=()):
+    """
+    Maximum of the modification stamps and deletion stamps, None if there are none.
+    """
+    stamps = [int(i) for i in values if not pd.isna(i) and str(i) != ""]
+    stamps += [int(i["stamp"]) for i in deleted_items if "stamp" in i]
+    return max(stamps) if len(stamps) > 0 else None
 
 
-def get_tokens(config):
-    access_token = None
-    refresh_token = None
-    if os.path.isfile(TOKEN_FILENAME):
-        with open(TOKEN_FILENAME,"rt") as f:
-            s = f.read().split('\n')
-            if len(s) == 2:
-                access_token, refresh_token = s[0], s[1]
-                logging.info("Access token from file: %s", access_token)
-                logging.info("Refresh token from file: %s",refresh_token)
-                access_token, refresh_token = refresh_tokens(config, access_token, refresh_token)
+def update_sync_state(sync_state, parameter_name, new_stamp):
+    if new_stamp is not None:
+        sync_state[parameter_name] = max(sync_state.get(parameter_name, new_stamp), new_stamp)
 
-    if access_token is None or refresh_token is None:
-        access_token, refresh_token = get_tokens_from_scratch(config)
 
-    logging.info("Obtained tokens successfully")
-    logging.info("Final access token: %s", access_token)
-    logging.info("Final refresh token: %s",refresh_token)
-    return access_token, refresh_token
+def remove_item_files(path, prefixes, ids):
+    for i in ids:
+        for prefix in prefixes:
+            remove_table(path+prefix+str(i)+".csv")
 
 
 def generic_get_and_backup(access_token: str, parameter_name: str,
@@ -169,17 +272,18 @@ def generic_get_and_backup(access_token: str, parameter_name: str,
         filename: str=None, readable_table_name: str=None,
         url_additions: dict={}, start_from=0, return_json: bool=False):
     result_df = pd.DataFrame(columns=default_fields+optional_fields)
+    result_json_parsed = None
     readable_table_name = \
         readable_table_name if readable_table_name is not None else parameter_name
     url = API_URL_PREFIX + parameter_name + GET_URL_POSTFIX
     try:
-        # TODO consider parameters: after=1234567890&f=xml
+        # TODO consider parameters: f=xml
         data = {'access_token': access_token}
         if len(optional_fields)>0:
             data['fields'] = ",".join(optional_fields)
         for i in url_additions:
             data[i] = url_additions[i]
-        response = requests.post(url, data = data)
+        response = client.post(url, data)
         if response.status_code == 200:
             result_json_parsed = json.loads(response.text)
             if type(result_json_parsed) == list:
@@ -199,11 +303,7 @@ def generic_get_and_backup(access_token: str, parameter_name: str,
         logging.warning("Failed to list %s: %s", readable_table_name, str(e))
 
     if filename is not None:
-        try:
-            result_df.to_csv(filename, index=False)
-            logging.info("Saved %s successfully", readable_table_name)
-        except Exception as e:
-            logging.warning("Failed to backup %s: %s", readable_table_name, str(e))
+        save_table(result_df, filename, readable_table_name, schema=SCHEMAS.get(parameter_name))
     else:
         logging.info("No filename provided. Not saving %s.", readable_table_name)
     if return_json:
@@ -211,108 +311,439 @@ def generic_get_and_backup(access_token: str, parameter_name: str,
     return result_df
 
 
-def get_raw_tasks(access_token):
+class IncompleteResponseError(ValueError):
+    """
+    The response body ended before its JSON array did, e.g. the connection was closed halfway through.
+    """
+
+
+def iter_json_array(response, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Incrementally parses the JSON array in the streamed response body and yields its
+    elements one by one. Only the current chunk and the element being decoded are kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = response.iter_content(chunk_size=chunk_size)
+    buffer = ""
+    pos = 0
+    started = False
+    exhausted = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer):
+            if not started:
+                if buffer[pos] != "[":
+                    # Most likely an error object. Read it fully, it is small.
+                    rest = buffer[pos:] + "".join(text_decoder.decode(c) for c in chunks)
+                    raise ValueError("Expected JSON array, got: " + rest)
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                # An element that ends exactly at the buffer end might be cut (e.g. a number)
+                if end < len(buffer) or exhausted:
+                    yield item
+                    pos = end
+                    continue
+            except ValueError as e:
+                if exhausted:
+                    raise IncompleteResponseError("Unexpected end of JSON array: " + str(e))
+        elif exhausted:
+            raise IncompleteResponseError("Unexpected end of JSON array")
+        buffer = buffer[pos:]
+        pos = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer += text_decoder.decode(b"", final=True)
+        else:
+            buffer += text_decoder.decode(chunk)
+
+
+def read_page(response, parameter_name, readable_table_name, start):
+    """
+    (total, items) of the streamed page of the endpoint with num/total as the first element.
+    None if the response is an error.
+    """
+    if response.status_code != 200:
+        logging.warning(
+            "Failed to read %s from %d. Response status code: %d.\n Detailed response: %s",
+            readable_table_name, start, response.status_code, str(response.text))
+        metrics.observe_failure(parameter_name, "status %d" % response.status_code)
+        return None
+    items = iter_json_array(response)
+    summary = next(items, None)
+    if type(summary) != dict or "total" not in summary:
+        logging.warning("Failed to read %s from %d. Unexpected first element: %s",
+                readable_table_name, start, summary)
+        metrics.observe_failure(parameter_name, "unexpected response")
+        return None
+    return int(summary["total"]), list(items)
+
+
+def generic_get_and_backup_paged(access_token: str, parameter_name: str,
+        default_fields: list, filename: str, optional_fields: list = [],
+        readable_table_name: str=None, url_additions: dict={},
+        page_size: int=DEFAULT_TASKS_PAGE_SIZE):
+    """
+    Paginated version of generic_get_and_backup for the endpoints that support start/num
+    windows and report num/total as the first element (tasks, notes). Every page is parsed
+    while it streams in and appended to the file right away, so memory use is bounded by
+    the page size, not by the account size. Returns the number of saved rows, or None
+    if the fetch failed and the file is incomplete.
+    """
+    columns = default_fields+optional_fields
+    readable_table_name = \
+        readable_table_name if readable_table_name is not None else parameter_name
+    url = API_URL_PREFIX + parameter_name + GET_URL_POSTFIX
+    data = {'access_token': access_token, 'num': page_size}
+    if len(optional_fields)>0:
+        data['fields'] = ",".join(optional_fields)
+    for i in url_additions:
+        data[i] = url_additions[i]
+    saved_rows = 0
+    try:
+        with TableWriter(filename, columns, SCHEMAS.get(parameter_name)) as writer:
+            start = 0
+            total = None
+            while total is None or start < total:
+                data['start'] = start
+                # A page cut halfway through is fetched again from the same start
+                result = client.post_and_read(url, data,
+                    lambda response: read_page(response, parameter_name, readable_table_name, start),
+                    retry_on=client.READ_ERRORS+(IncompleteResponseError,))
+                if result is None:
+                    writer.abort()
+                    return None
+                total, page = result
+                if len(page) == 0:
+                    break
+                writer.write(pd.DataFrame(page, columns=columns))
+                saved_rows += len(page)
+                start += len(page)
+                logging.info("Read %s: %d of %d", readable_table_name, start, total)
+        logging.info("Saved %d %s successfully", saved_rows, readable_table_name)
+    except Exception as e:
+        logging.warning("Failed to backup %s: %s", readable_table_name, str(e))
+        metrics.observe_failure(parameter_name, str(e))
+        return None
+    return saved_rows
+
+
+def generic_get_and_backup_incremental(access_token: str, parameter_name: str,
+        default_fields: list, filename: str, sync_state: dict, optional_fields: list = [],
+        readable_table_name: str=None, page_size: int=DEFAULT_TASKS_PAGE_SIZE):
+    """
+    Fetches only the items modified or deleted since the stamp stored in sync_state and merges
+    them into the existing file. Without a stamp or a file does the full paginated fetch.
+    The stamp is moved forward only on success, so a failed run is repeated from the same point.
+    Returns the number of the fetched rows (the changed ones only, if merged), None if the fetch failed.
+    """
+    readable_table_name = \
+        readable_table_name if readable_table_name is not None else parameter_name
+    after = sync_state.get(parameter_name)
+    if after is None or not table_exists(filename):
+        saved_rows = generic_get_and_backup_paged(access_token=access_token,
+            parameter_name=parameter_name, default_fields=default_fields,
+            optional_fields=optional_fields, filename=filename,
+            readable_table_name=readable_table_name, page_size=page_size)
+        if saved_rows is not None:
+            update_sync_state(sync_state, parameter_name,
+                latest_stamp(read_table(filename, columns=["modified"])["modified"]))
+        return saved_rows
+    after -= AFTER_OVERLAP_SECONDS
+    delta = delta_filename(filename)
+    saved_rows = generic_get_and_backup_paged(access_token=access_token,
+        parameter_name=parameter_name, default_fields=default_fields,
+        optional_fields=optional_fields, filename=delta,
+        readable_table_name="changed "+readable_table_name,
+        url_additions={"after": after}, page_size=page_size)
+    deleted = get_deleted_items(access_token, parameter_name, after)
+    if saved_rows is None or deleted is None:
+        logging.warning("Failed to fetch changes of %s. Keeping the previous backup.", readable_table_name)
+        metrics.observe_failure(parameter_name, "changes not fetched")
+        remove_table(delta)
+        return None
+    modified = read_table(delta, columns=["modified"])["modified"]
+    merge_delta_table(filename, delta, "id", [i["id"] for i in deleted], SCHEMAS.get(parameter_name))
+    logging.info("Merged %d changed and %d deleted %s", saved_rows, len(deleted), readable_table_name)
+    update_sync_state(sync_state, parameter_name, latest_stamp(modified, deleted))
+    return saved_rows
+
+
+def read_saved_table(filename, columns, schema=None):
+    if not table_exists(filename):
+        return pd.DataFrame(columns=columns)
+    return read_table(filename, schema=schema)
+
+
+def read_stage_result(backup_path, name):
+    """
+    Result of the stage as saved in the backup folder: its first table.
+    """
+    return read_saved_table(backup_path+STAGE_TABLES[name][0], list(SCHEMAS.get(name, {})), SCHEMAS.get(name))
+
+
+def get_raw_tasks(access_token, filename=None, page_size=None, sync_state=None):
     """
     Raw tasks contain some fields in human-unreadable form. For example, folder or context.
+    If page_size is set, tasks are fetched page by page and streamed into filename.
+    If sync_state is set, only the changes since the previous run are fetched and merged into filename.
+    Returns the number of the fetched tasks, None if the fetch failed. They are not kept in memory:
+    the merge reads them back from filename.
     """
-    return generic_get_and_backup(access_token=access_token, parameter_name='tasks',
+    if sync_state is not None:
+        return generic_get_and_backup_incremental(access_token=access_token, parameter_name='tasks',
+            default_fields=DEFAULT_TASK_FIELDS, optional_fields=OPTIONAL_TASK_FIELDS,
+            filename=filename, sync_state=sync_state, readable_table_name="raw tasks",
+            page_size=page_size if page_size is not None else DEFAULT_TASKS_PAGE_SIZE)
+    if page_size is None:
+        return len(generic_get_and_backup(access_token=access_token, parameter_name='tasks',
+            default_fields=DEFAULT_TASK_FIELDS, optional_fields=OPTIONAL_TASK_FIELDS,
+            filename=filename, readable_table_name="raw tasks", start_from=1))
+    return generic_get_and_backup_paged(access_token=access_token, parameter_name='tasks',
         default_fields=DEFAULT_TASK_FIELDS, optional_fields=OPTIONAL_TASK_FIELDS,
-        readable_table_name="raw tasks", start_from=1)
+        filename=filename, readable_table_name="raw tasks", page_size=page_size)
 
 
-def get_and_backup_folders(access_token, filename):
-    return generic_get_and_backup(access_token=access_token, filename=filename,
-            parameter_name='folders', default_fields=DEFAULT_FOLDER_FIELDS)
+def get_and_backup_reference_table(access_token, parameter_name, filename, default_fields, cache=None):
+    """
+    With the cache, the table is fetched only if it was edited since it was saved.
+    If the fetch fails, the table saved earlier is kept and returned.
+    """
+    if cache is not None and cache.is_fresh(parameter_name, [filename]):
+        logging.info("%s did not change since the last run. Using the saved table.", parameter_name.capitalize())
+        return cache.get_table(parameter_name,
+            lambda: read_saved_table(filename, default_fields, SCHEMAS[parameter_name]))
+    result_df, result_json_parsed = generic_get_and_backup(access_token=access_token,
+            parameter_name=parameter_name, default_fields=default_fields, return_json=True)
+    if type(result_json_parsed) != list:
+        # The merge takes the names from the previous table rather than from none
+        logging.warning("Failed to fetch %s. Keeping the previous backup.", parameter_name)
+        metrics.observe_failure(parameter_name, "not fetched")
+        return read_saved_table(filename, default_fields, SCHEMAS[parameter_name])
+    save_table(result_df, filename, parameter_name, schema=SCHEMAS[parameter_name])
+    if cache is not None:
+        cache.update(parameter_name, [filename], result_df)
+    return result_df
+
 
+def get_and_backup_folders(access_token, filename, cache=None):
+    return get_and_backup_reference_table(access_token=access_token, parameter_name='folders',
+            filename=filename, default_fields=DEFAULT_FOLDER_FIELDS, cache=cache)
 
-def get_and_backup_contexts(access_token, filename):
-    return generic_get_and_backup(access_token=access_token, filename=filename,
-        parameter_name='contexts', default_fields=DEFAULT_CONTEXT_FIELDS)
 
+def get_and_backup_contexts(access_token, filename, cache=None):
+    return get_and_backup_reference_table(access_token=access_token, parameter_name='contexts',
+            filename=filename, default_fields=DEFAULT_CONTEXT_FIELDS, cache=cache)
 
-def get_and_backup_goals(access_token, filename):
-    return generic_get_and_backup(access_token=access_token, filename=filename,
-        parameter_name='goals', default_fields=DEFAULT_GOAL_FIELDS)
 
+def get_and_backup_goals(access_token, filename, cache=None):
+    return get_and_backup_reference_table(access_token=access_token, parameter_name='goals',
+            filename=filename, default_fields=DEFAULT_GOAL_FIELDS, cache=cache)
 
-def get_and_backup_locations(access_token, filename):
-    return generic_get_and_backup(access_token=access_token, filename=filename,
-        parameter_name='locations', default_fields=DEFAULT_LOCATION_FIELDS)
 
+def get_and_backup_locations(access_token, filename, cache=None):
+    return get_and_backup_reference_table(access_token=access_token, parameter_name='locations',
+            filename=filename, default_fields=DEFAULT_LOCATION_FIELDS, cache=cache)
 
-def get_and_backup_notes(access_token, filename):
-    return generic_get_and_backup(access_token=access_token, filename=filename,
+
+def get_and_backup_notes(access_token, filename, sync_state=None):
+    """
+    Returns the number of the fetched notes, None if the fetch failed.
+    """
+    # Like tasks, notes come in pages with num/total as the first element
+    if sync_state is not None:
+        return generic_get_and_backup_incremental(access_token=access_token, filename=filename,
+            parameter_name='notes', default_fields=DEFAULT_NOTES_FIELDS, sync_state=sync_state)
+    return generic_get_and_backup_paged(access_token=access_token, filename=filename,
         parameter_name='notes', default_fields=DEFAULT_NOTES_FIELDS)
 
 
-def backup_list_details(access_token, list_info, lists_path):
-    list_col_df = pd.DataFrame(list_info["cols"])
-    try:
-        list_col_df.to_csv(lists_path+"cols_list_"+str(list_info["id"])+".csv", index=False)
-        logging.info("Saved list %s columns successfully", list_info["id"])
-    except Exception as e:
-        logging.warning("Failed to backup list %s columns: %s", list_info["id"], str(e))
-    #http://api.toodledo.com/3/rows/get.php?access_token=yourtoken&after=1234567890&list=1234567890
+def flatten_list_cells(row_json, cols, list_id=None):
+    """
+    Turns the cells of the list rows into the long table with one (value, row_id, column_ids)
+    record per row and column, row by row. Cell "cN" belongs to the N-th column. Missing cells
+    are None, cells beyond the last column have no column and are dropped.
+    """
+    column_ids = [i["id"] for i in cols]
+    cell_keys = ["c"+str(j+1) for j in range(len(column_ids))]
+    row_ids = [i["id"] for i in row_json]
+    # Empty cells come as [] rather than {}
+    # from_records would drop the rows if none of them had cells
+    cells = pd.DataFrame([i["cells"] if type(i.get("cells")) == dict else {} for i in row_json],
+                         index=range(len(row_json)))
+    extra_keys = [i for i in cells.columns if i not in cell_keys]
+    if len(extra_keys) > 0:
+        logging.warning("List %s has cells without columns: %s. Skipping them.", list_id, extra_keys)
+    values = cells.reindex(columns=cell_keys).to_numpy(dtype=object, copy=True)
+    values[pd.isna(values)] = None
+    # Object dtype keeps the missing cells None instead of NaN
+    return pd.DataFrame({"value": pd.Series(values.ravel(), dtype=object),
+                         "row_id": np.repeat(np.array(row_ids, dtype=object), len(column_ids)),
+                         "column_ids": np.tile(np.array(column_ids, dtype=object), len(row_ids))})
+
+
+def list_item_filenames(lists_path, list_id):
+    """
+    Rows, columns and cells of the list.
+    """
+    return [lists_path+prefix+str(list_id)+".csv" for prefix in LIST_ITEM_PREFIXES]
+
+
+def backup_list_details(access_token, list_info, lists_path, journal=None):
+    """
+    Fetches the rows of the list and saves its rows, columns and cells. Returns None if the rows could
+    not be fetched: the files saved earlier are left as they are.
+    """
+    rows_filename, cols_filename, cells_filename = list_item_filenames(lists_path, list_info["id"])
+    #http://api.toodledo.com/3/rows/get.php?access_token=yourtoken&list=1234567890
     list_row_df, row_json =generic_get_and_backup(
         access_token=access_token,
         parameter_name='rows',
         default_fields=LIST_ROW_DEFAULT_FIELDS,
-        filename=lists_path+"rows_list_"+str(list_info["id"])+".csv",
+        readable_table_name="list "+str(list_info["id"])+" rows",
         url_additions={"list": list_info["id"]},
         return_json=True)
-    row_ids = list()
-    col_ids = list()
-    values = list()
+    if type(row_json) != list:
+        metrics.observe_failure("lists", "rows of list %s not fetched" % list_info["id"])
+        return None
+    list_col_df = pd.DataFrame(list_info["cols"])
+    save_table(list_col_df, cols_filename, "list "+str(list_info["id"])+" columns", schema=SCHEMAS["cols"])
+    save_table(list_row_df, rows_filename, "list "+str(list_info["id"])+" rows", schema=SCHEMAS["rows"])
     if len(list_row_df) > 0:
-        for i in range(len(row_json)):
-            for j in range(len(row_json[i]["cells"])):
-                if ("c"+str(j+1)) in row_json[i]["cells"]:
-                    values.append(row_json[i]["cells"]["c"+str(j+1)])
-                else:
-                    values.append(None)
-                col_ids.append(list_info["cols"][j]["id"])
-                row_ids.append(row_json[i]["id"])
-        list_cell_df = pd.DataFrame({"value": values, "row_id": row_ids, "column_ids": col_ids})
+        list_cell_df = flatten_list_cells(row_json, list_info["cols"], list_info["id"])
     else:
         list_cell_df = pd.DataFrame({"value": [], "row_id": [], "column_ids": []})
+    cells_saved = save_table(list_cell_df, cells_filename, "list "+str(list_info["id"])+" cells",
+            schema=SCHEMAS["cells"])
+    if journal is not None and cells_saved:
+        journal.finish_item("list", list_info["id"], list_info.get("modified"),
+                list_item_filenames(lists_path, list_info["id"]))
     list_cell_df["list_id"] = list_info["id"]
     list_row_df["list_id"] = list_info["id"]
     list_col_df["list_id"] = list_info["id"]
     return list_row_df, list_col_df, list_cell_df
 
 
-def get_and_backup_lists(access_token, backup_path):
-    result_df = pd.DataFrame(columns=["id","added","modified","title","version","note","keywords","rows"])
+def load_list_details(list_info, lists_path):
+    """
+    Same as backup_list_details, but from the files saved earlier. Empty if there are none.
+    """
+    rows_filename, cols_filename, cells_filename = list_item_filenames(lists_path, list_info["id"])
+    list_row_df = read_saved_table(rows_filename, LIST_ROW_DEFAULT_FIELDS, SCHEMAS["rows"])
+    list_col_df = read_saved_table(cols_filename, LIST_COL_DEFAULT_FIELDS, SCHEMAS["cols"])
+    list_cell_df = read_saved_table(cells_filename, LIST_CELL_FIELDS, SCHEMAS["cells"])
+    list_cell_df["list_id"] = list_info["id"]
+    list_row_df["list_id"] = list_info["id"]
+    list_col_df["list_id"] = list_info["id"]
+    return list_row_df, list_col_df, list_cell_df
+
+
+def map_bounded(executor, function, items, window):
+    """
+    Like executor.map, but with at most window items submitted and not yet consumed,
+    so that the results waiting to be consumed do not pile up in memory.
+    """
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, item))
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def get_list_details(access_token, list_info, lists_path, journal, failed):
+    """
+    Rows, columns and cells of the list: read from its files if the interrupted run finished it,
+    fetched otherwise. If the fetch fails, the list id goes to failed, and its previous
+    files are used instead, so that the aggregates keep what they had for it.
+    """
+    if journal is not None and journal.item_done("list", list_info["id"], list_info.get("modified")):
+        return load_list_details(list_info, lists_path)
+    list_details = backup_list_details(access_token, list_info, lists_path, journal)
+    if list_details is None:
+        failed.append(list_info["id"])
+        return load_list_details(list_info, lists_path)
+    return list_details
+
+
+def get_and_backup_lists(access_token, backup_path, sync_state=None, journal=None):
+    """
+    Every list is fetched, saved, appended to the aggregate tables (lists_rows, lists_cols, lists_cells)
+    and released right away, so memory use does not grow with the number of lists. The aggregates
+    replace the previous ones only once all the lists are done.
+    If sync_state has a stamp for lists, only the lists changed since then are fetched
+    (each one with all its rows) and merged into the existing files. Deleted lists are removed.
+    If the run journal has a list unchanged since the interrupted run finished it, the list is read
+    from its files instead of being fetched again.
+    Returns the table of lists.
+    """
+    result_df = pd.DataFrame(columns=LIST_DEFAULT_FIELDS)
     url = API_URL_PREFIX + "lists" + GET_URL_POSTFIX
-    all_list_rows = None
-    all_list_cols = None
-    all_list_cells = None
+    lists_path = backup_path+"Lists"+os.path.sep
+    # Aggregate name (as in SCHEMAS) -> filename and columns
+    aggregates = {
+        "rows": (backup_path+'lists_rows.csv', LIST_ROW_DEFAULT_FIELDS+["list_id"]),
+        "cols": (backup_path+'lists_cols.csv', LIST_COL_DEFAULT_FIELDS+["list_id"]),
+        "cells": (backup_path+'lists_cells.csv', LIST_CELL_FIELDS+["list_id"]),
+    }
+    # Aggregates that are written as deltas and merged afterwards
+    merged = []
+    after = None
+    if sync_state is not None and "lists" in sync_state and table_exists(backup_path+'lists.csv'):
+        after = sync_state["lists"] - AFTER_OVERLAP_SECONDS
+    deleted = []
+    # Lists whose rows could not be fetched
+    failed = []
+    fetched = False
     try:
-        # TODO consider parameters: after=1234567890&f=xml
+        # TODO consider parameters: f=xml
         data = {'access_token': access_token}
-        response = requests.post(url, data = data)
+        if after is not None:
+            data['after'] = after
+            deleted = get_deleted_items(access_token, "lists", after)
+            if deleted is None:
+                logging.warning("Failed to fetch changes of lists. Keeping the previous backup.")
+                metrics.observe_failure("lists", "deleted lists not fetched")
+                return result_df
+        response = client.post(url, data)
         if response.status_code == 200:
             result_json_parsed = json.loads(response.text)
-            lists_path = backup_path+"Lists"+os.path.sep
             if not os.path.isdir(lists_path):
                 logging.info("Lists directory did not exist. Creating...")
                 os.mkdir(lists_path)
             if type(result_json_parsed) == list:
+                writers = []
+                try:
+                    for name in aggregates:
+                        filename, columns = aggregates[name]
+                        if after is not None and table_exists(filename):
+                            merged.append(name)
+                            filename = delta_filename(filename)
+                        writers.append(TableWriter(filename, columns, SCHEMAS[name]))
+                    with ThreadPoolExecutor(max_workers=client.max_concurrent_requests) as executor:
+                        for list_details in map_bounded(executor,
+                                lambda i: get_list_details(access_token, i, lists_path, journal, failed),
+                                result_json_parsed, 2*client.max_concurrent_requests):
+                            for writer, df in zip(writers, list_details):
+                                writer.write(df)
+                except BaseException:
+                    for writer in writers:
+                        writer.abort()
+                    raise
+                for writer in writers:
+                    writer.close()
+                logging.info("Saved all list rows, columns and cells successfully")
+                fetched = True
                 if len(result_json_parsed) > 0:
                     for i in result_json_parsed:
-                        cur_list_rows, cur_list_cols, cur_list_cells = backup_list_details(access_token, i, lists_path)
-                        if all_list_rows is None:
-                            all_list_rows = cur_list_rows
-                        else:
-                            all_list_rows = all_list_rows.append(cur_list_rows, ignore_index=True)
-                        if all_list_cols is None:
-                            all_list_cols = cur_list_cols
-                        else:
-                            all_list_cols = all_list_cols.append(cur_list_cols, ignore_index=True)
-                        if all_list_cells is None:
-                            all_list_cells = cur_list_cells
-                        else:
-                            all_list_cells = all_list_cells.append(cur_list_cells, ignore_index=True)
                         del i["cols"]
                     result_df = pd.DataFrame(result_json_parsed)
                     logging.info("Read lists successfully")
@@ -327,63 +758,101 @@ def get_and_backup_lists(access_token, backup_path):
     except Exception as e:
         logging.warning("Failed to lists lists: %s", str(e))
 
-    try:
-        result_df.to_csv(backup_path+'lists.csv', index=False)
-        logging.info("Saved lists successfully")
-    except Exception as e:
-        logging.warning("Failed to backup lists: %s", str(e))
-
-    try:
-        all_list_rows.to_csv(backup_path+'lists_rows.csv', index=False)
-        logging.info("Saved all list rows successfully")
-    except Exception as e:
-        logging.warning("Failed to backup list rows: %s", str(e))
-
-    try:
-        all_list_cols.to_csv(backup_path+'lists_cols.csv', index=False)
-        logging.info("Saved all list columns successfully")
-    except Exception as e:
-        logging.warning("Failed to backup list columns: %s", str(e))
-
-    try:
-        all_list_cells.to_csv(backup_path+'lists_cells.csv', index=False)
-        logging.info("Saved all list cells successfully")
-    except Exception as e:
-        logging.warning("Failed to backup list cells: %s", str(e))
-
-    return result_df, all_list_rows, all_list_cols
+    if not fetched:
+        logging.warning("Failed to fetch lists. Keeping the previous backup.")
+        metrics.observe_failure("lists", "not fetched")
+        return result_df
+    if after is None:
+        saved = save_table(result_df, backup_path+'lists.csv', "lists", schema=SCHEMAS["lists"])
+    else:
+        deleted_ids = [i["id"] for i in deleted]
+        saved = save_table(result_df, backup_path+'lists.csv', "lists",
+                merge_on="id", removed_keys=deleted_ids, schema=SCHEMAS["lists"])
+        try:
+            for name in merged:
+                filename = aggregates[name][0]
+                merge_delta_table(filename, delta_filename(filename), "list_id",
+                        list(result_df["id"]) + deleted_ids, SCHEMAS[name])
+            logging.info("Merged changes of %d lists", len(result_df)+len(deleted_ids))
+        except Exception as e:
+            logging.warning("Failed to merge list changes: %s", str(e))
+            metrics.observe_failure("lists", str(e))
+            saved = False
+        remove_item_files(lists_path, LIST_ITEM_PREFIXES, deleted_ids)
+
+    if len(failed) > 0:
+        # Their changes are fetched again by the next run
+        logging.warning("Failed to fetch the rows of lists %s. Keeping their previous backup.", failed)
+        saved = False
+    if sync_state is not None and saved:
+        update_sync_state(sync_state, "lists", latest_stamp(result_df["modified"], deleted))
+    return result_df
 
 
-def get_and_backup_outlines(access_token, backup_path):
-    all_outline_rows = None
-    result_df = pd.DataFrame(columns=["id","added","modified","title","hidden","version","note","keywords","count", "updated_at"])
+def get_and_backup_outlines(access_token, backup_path, sync_state=None, journal=None):
+    """
+    The nodes of every outline are saved and appended to outlines_rows right away, the aggregate
+    replaces the previous one only once all the outlines are done.
+    If sync_state has a stamp for outlines, only the outlines changed since then are fetched
+    and merged into the existing files. Deleted outlines are removed.
+    Outlines that the interrupted run (per the run journal) saved already are not saved again.
+    Returns the table of outlines.
+    """
+    result_df = pd.DataFrame(columns=OUTLINE_DEFAULT_FIELDS)
     url = API_URL_PREFIX + "outlines" + GET_URL_POSTFIX
+    outlines_path = backup_path+"Outlines"+os.path.sep
+    rows_filename = backup_path+'outlines_rows.csv'
+    merged = False
+    after = None
+    if sync_state is not None and "outlines" in sync_state and table_exists(backup_path+'outlines.csv'):
+        after = sync_state["outlines"] - AFTER_OVERLAP_SECONDS
+    deleted = []
+    fetched = False
     try:
-        # TODO consider parameters: after=1234567890&f=xml
+        # TODO consider parameters: f=xml
         data = {'access_token': access_token}
-        response = requests.post(url, data = data)
+        if after is not None:
+            data['after'] = after
+            deleted = get_deleted_items(access_token, "outlines", after)
+            if deleted is None:
+                logging.warning("Failed to fetch changes of outlines. Keeping the previous backup.")
+                metrics.observe_failure("outlines", "deleted outlines not fetched")
+                return result_df
+        response = client.post(url, data)
         if response.status_code == 200:
             result_json_parsed = json.loads(response.text)
-            outlines_path = backup_path+"Outlines"+os.path.sep
             if not os.path.isdir(outlines_path):
                 logging.info("Outlines directory did not exist. Creating...")
                 os.mkdir(outlines_path)
             if type(result_json_parsed) == list:
-                if len(result_json_parsed) > 0:
+                # Nodes of different outlines can have different fields
+                row_columns = []
+                for i in result_json_parsed:
+                    for node in i.get("outline", {}).get("children", []):
+                        row_columns += [k for k in node if k not in row_columns]
+                row_columns.append("outline_id")
+                merged = after is not None and table_exists(rows_filename)
+                with TableWriter(delta_filename(rows_filename) if merged else rows_filename,
+                        row_columns, SCHEMAS["outline_rows"]) as writer:
                     for i in result_json_parsed:
                         try:
                             cur_outline_df = pd.DataFrame(i["outline"]["children"])
-                            if all_outline_rows is None:
-                                all_outline_rows = cur_outline_df
-                            else:
-                                all_outline_rows = all_outline_rows.append(cur_outline_df, ignore_index=True)
-                            pd.DataFrame(cur_outline_df.to_csv(outlines_path+"outline_"+str(i["id"])+".csv", index=False))
-                            logging.info("Saved outline %s successfully", i["id"])
+                            cur_outline_df["outline_id"] = i["id"]
+                            writer.write(cur_outline_df)
+                            outline_filename = outlines_path+"outline_"+str(i["id"])+".csv"
+                            if journal is None or not journal.item_done("outline", i["id"], i.get("modified")):
+                                if save_table(cur_outline_df, outline_filename, "outline "+str(i["id"]),
+                                        schema=SCHEMAS["outline_rows"]) and journal is not None:
+                                    journal.finish_item("outline", i["id"], i.get("modified"), [outline_filename])
                         except Exception as e:
                             logging.warning("Failed to backup outline %s: %s", i["id"], str(e))
+                            metrics.observe_failure("outlines", str(e))
                         i["count"] = i["outline"]["count"]
                         i["updated_at"] = i["outline"]["updated_at"]
                         del i["outline"]
+                logging.info("Saved outlines rows successfully")
+                fetched = True
+                if len(result_json_parsed) > 0:
                     result_df = pd.DataFrame(result_json_parsed)
                     logging.info("Read outlines successfully")
                 else:
@@ -397,70 +866,137 @@ def get_and_backup_outlines(access_token, backup_path):
     except Exception as e:
         logging.warning("Failed to list outlines: %s", str(e))
 
-    try:
-        result_df.to_csv(backup_path+'outlines.csv', index=False)
-        logging.info("Saved outlines successfully")
-    except Exception as e:
-        logging.warning("Failed to backup outlines: %s", str(e))
+    if not fetched:
+        logging.warning("Failed to fetch outlines. Keeping the previous backup.")
+        metrics.observe_failure("outlines", "not fetched")
+        return result_df
+    if after is None:
+        saved = save_table(result_df, backup_path+'outlines.csv', "outlines", schema=SCHEMAS["outlines"])
+    else:
+        deleted_ids = [i["id"] for i in deleted]
+        saved = save_table(result_df, backup_path+'outlines.csv', "outlines",
+                merge_on="id", removed_keys=deleted_ids, schema=SCHEMAS["outlines"])
+        try:
+            if merged:
+                merge_delta_table(rows_filename, delta_filename(rows_filename), "outline_id",
+                        list(result_df["id"]) + deleted_ids, SCHEMAS["outline_rows"])
+            logging.info("Merged changes of %d outlines", len(result_df)+len(deleted_ids))
+        except Exception as e:
+            logging.warning("Failed to merge outline changes: %s", str(e))
+            metrics.observe_failure("outlines", str(e))
+            saved = False
+        remove_item_files(outlines_path, ["outline_"], deleted_ids)
 
-    try:
-        all_outline_rows.to_csv(backup_path+'outlines_rows.csv', index=False)
-        logging.info("Saved outlines rows successfully")
-    except Exception as e:
-        logging.warning("Failed to backup outlines rows: %s", str(e))
+    if sync_state is not None and saved:
+        update_sync_state(sync_state, "outlines", latest_stamp(result_df["modified"], deleted))
+    return result_df
 
-    return result_df, all_outline_rows
+
+def make_readable_tasks(raw_tasks_df, name_indexes):
+    """
+    Adds <field>_name columns to the raw tasks, e.g. folder_name for folder. name_indexes maps
+    the task field to the build_name_index of its table. Every field is resolved with one
+    vectorized lookup, the task table is copied once. Ids without a name (like 0 for no folder) get none.
+    """
+    names = {}
+    for field in name_indexes:
+        if field in raw_tasks_df.columns:
+            names[field+"_name"] = pd.to_numeric(raw_tasks_df[field], errors="coerce").map(name_indexes[field])
+    return raw_tasks_df.assign(**names)
+
+
+def merge_tasks(backup_path, raw_tasks_df, reference_dfs, cache=None):
+    """
+    Saves the readable tasks: the raw ones with the names of their folders, contexts, goals and
+    locations. reference_dfs maps the reference table to its DataFrame.
+    """
+    # With this databases you can merge a lot of things.
+    logging.info("Started the merge of tasks. Shape: %s", str(raw_tasks_df.shape))
+    readable_tasks_df = make_readable_tasks(raw_tasks_df, {
+        # "folders" -> "folder", etc.
+        table[:-1]: cache.name_index(table, reference_dfs[table]) if cache is not None
+            else build_name_index(reference_dfs[table])
+        for table in REFERENCE_TABLES})
+    logging.info("Merged contexts, locations, folders and goals. Shape: %s", str(readable_tasks_df.shape))
+    save_table(readable_tasks_df, backup_path+'tasks.csv', "readable tasks", schema=SCHEMAS["tasks"])
+    logging.info("Finished writing tasks.")
+    # Double-check that saving did not lose any task
+    missing = diff_backups.find_missing_keys(backup_path+'tasks.csv', backup_path+'raw_tasks.csv', ["id"])
+    if len(missing) > 0:
+        logging.warning("%d raw tasks are missing from the readable tasks, e.g. %s", len(missing), missing[:10])
+
+
+def run_backup(config, token_filename=TOKEN_FILENAME, interactive=True, entities=None, refresh=True):
+    """
+    Backs up the account of the tokens in token_filename to the BACKUP_FOLDER of the config.
+    Only the given ENTITIES are fetched, all of them by default; the rest stay as they are.
+    Without interactive, fails instead of asking the user to authorize the account.
+    Without refresh, the saved tokens are used as they are until the API rejects them.
+    Returns the run report.
+    """
+    metrics.reset()
+    entities = ENTITIES if entities is None else entities
+    access_token, refresh_token = get_tokens(config, token_filename, interactive=interactive, refresh=refresh)
+    save_tokens(access_token, refresh_token, token_filename)
+    backup_path = get_backup_path(config)
+    logging.info("Path for the backups: %s", backup_path)
+    os.makedirs(backup_path, exist_ok=True)
+    sync_state = load_sync_state(backup_path) if config.get(INCREMENTAL_FIELD, False) else None
+    storage.set_backup_formats(config.get(BACKUP_FORMATS_FIELD, [storage.CSV_FORMAT]))
+    configure_client(config, refresh_token, token_filename)
+    # TODO Re-save notes one-by-one?
+    journal = run_journal.RunJournal(backup_path, resume=config.get(RESUME_FIELD, True))
+    # One request for the stamps of the reference tables instead of four for the tables
+    cache = reference_cache.ReferenceCache(backup_path, get_account_info(access_token)) \
+        if config.get(REFERENCE_CACHE_FIELD, True) and any(i in entities for i in REFERENCE_TABLES) else None
+    # None of the stages depends on another one, so they all run at once.
+    all_stages = {
+        "tasks": lambda: get_raw_tasks(access_token=access_token, filename=backup_path+'raw_tasks.csv',
+            page_size=config.get(TASKS_PAGE_SIZE_FIELD, DEFAULT_TASKS_PAGE_SIZE), sync_state=sync_state),
+        "folders": lambda: get_and_backup_folders(access_token=access_token, filename=backup_path+'folders.csv',
+            cache=cache),
+        "contexts": lambda: get_and_backup_contexts(access_token=access_token, filename=backup_path+'contexts.csv',
+            cache=cache),
+        "goals": lambda: get_and_backup_goals(access_token=access_token, filename=backup_path+'goals.csv',
+            cache=cache),
+        "locations": lambda: get_and_backup_locations(access_token=access_token,
+            filename=backup_path+'locations.csv', cache=cache),
+        "notes": lambda: get_and_backup_notes(access_token=access_token, filename=backup_path+'notes.csv',
+            sync_state=sync_state),
+        "lists": lambda: get_and_backup_lists(access_token=access_token, backup_path=backup_path,
+            sync_state=sync_state, journal=journal),
+        "outlines": lambda: get_and_backup_outlines(access_token=access_token, backup_path=backup_path,
+            sync_state=sync_state, journal=journal),
+    }
+    stages = {name: all_stages[name] for name in all_stages if name in entities}
+    results = run_concurrently({name: (lambda name=name: run_journaled(journal, name, backup_path,
+        stages[name], sync_state)) for name in stages})
+    if any(i in stages for i in ["tasks"]+REFERENCE_TABLES):
+        # The raw tasks are read back only now, so they are not held in memory while the other stages run.
+        # The reference tables that were not fetched in this run are taken from the backup folder.
+        run_journaled(journal, "merge", backup_path, lambda: run_stage("merge", lambda: merge_tasks(backup_path,
+            read_stage_result(backup_path, "tasks"),
+            {i: results[i] if results.get(i) is not None else read_stage_result(backup_path, i)
+             for i in REFERENCE_TABLES}, cache)))
+    if config.get(SNAPSHOTS_FIELD, False):
+        run_journaled(journal, "snapshot", backup_path,
+            lambda: run_stage("snapshot", lambda: snapshots.take_snapshot(backup_path)))
+    journal.finish()
+    run_report = metrics.save_report(os.path.join(backup_path, config.get(RUN_REPORT_FIELD, DEFAULT_RUN_REPORT)))
+    if config.get(PROMETHEUS_TEXTFILE_FIELD):
+        metrics.save_prometheus(os.path.join(backup_path, config[PROMETHEUS_TEXTFILE_FIELD]), run_report)
+    return run_report
 
 
 if __name__=="__main__":
     logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.INFO)
     # TODO setup logging properly. Log levels, templates, maybe file.
+    import yaml
     with open(CONFIG_FILENAME,"rt") as f:
         config = yaml.load(f, Loader=yaml.CLoader)
 
-    access_token, refresh_token = get_tokens(config)
-    save_tokens(access_token, refresh_token)
-    # TODO need folders and contexts to lookup and present in readable format?
-    backup_path = os.path.normpath(("" if os.path.isabs(config[BACKUP_FOLDER_FIELD]) else CUR_FILE_DIR)
-            + config[BACKUP_FOLDER_FIELD]) + os.path.sep
-    logging.info("Path for the backups: %s", backup_path)
-    raw_tasks_df = get_raw_tasks(access_token=access_token)
-    # TODO merge tasks to readable form and export them
-    folders_df = get_and_backup_folders(access_token=access_token, filename=backup_path+'folders.csv')
-    contexts_df = get_and_backup_contexts(access_token=access_token, filename=backup_path+'contexts.csv')
-    goals_df = get_and_backup_goals(access_token=access_token, filename=backup_path+'goals.csv')
-    locations_df = get_and_backup_locations(access_token=access_token, filename=backup_path+'locations.csv')
-    notes_df = get_and_backup_notes(access_token=access_token, filename=backup_path+'notes.csv')
-    # TODO Re-save notes one-by-one?
-    lists_df, all_list_rows, all_list_cols = get_and_backup_lists(access_token=access_token, backup_path=backup_path)
-    outline_df, all_outline_rows = get_and_backup_outlines(access_token=access_token, backup_path=backup_path)
-    # With this databases you can merge a lot of things.
-    readable_tasks_df = raw_tasks_df
-    logging.info("Started the merge of tasks. Shape: %s", str(readable_tasks_df.shape))
-    readable_tasks_df = pd.merge(readable_tasks_df,
-        contexts_df.rename({"name": "context_name","id": "context_id"},axis=1)[["context_id","context_name"]],
-        how="left", left_on="context", right_on="context_id")
-    logging.info("Merged context. Shape: %s", str(readable_tasks_df.shape))
-    readable_tasks_df = pd.merge(readable_tasks_df,
-        locations_df.rename({"name": "location_name","id": "location_id"},axis=1)[["location_id","location_name"]],
-        how="left", left_on="location", right_on="location_id")
-    logging.info("Merged locations. Shape: %s", str(readable_tasks_df.shape))
-    readable_tasks_df = pd.merge(readable_tasks_df,
-        folders_df.rename({"name": "folder_name","id": "folder_id"},axis=1)[["folder_id","folder_name"]],
-        how="left", left_on="folder", right_on="folder_id")
-    logging.info("Merged folders. Shape: %s", str(readable_tasks_df.shape))
-    readable_tasks_df = pd.merge(readable_tasks_df,
-        folders_df.rename({"name": "goal_name","id": "goal_id"},axis=1)[["goal_id","goal_name"]],
-        how="left", left_on="goal", right_on="goal_id")
-    logging.info("Merged goals. Shape: %s", str(readable_tasks_df.shape))
-    readable_tasks_df = readable_tasks_df.drop(["context_id","folder_id","location_id","goal_id"],axis=1)
-    readable_tasks_df.to_csv(backup_path+'tasks.csv', index=False)
-    logging.info("Finished writing tasks.")
-    # TODO double=check that saving did not remove an element here and there
+    run_backup(config)
 
     # TODO Subfolders for lists and notes? E.g. by name prefixes
-    # TODO Deleted items
-    # TODO All cells of all lists? along with row ID and column ID. Later - in progress
     # TODO Some tests (at least manual) to be sure? "Back and forth" (save, load, compare)?
-    # TODO Do not refresh tokens right away, make togglable
     # For each row go through each cell.
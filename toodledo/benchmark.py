@@ -0,0 +1,163 @@
+"""
+Offline benchmarks of the backup stages against the local mock API (mock_server.py), so the numbers
+cover the HTTP client, parsing and saving, but not the network. Every stage runs in a fresh process,
+so its peak RSS is its own. Per stage the report shows wall time, requests, bytes received from
+the API and peak RSS.
+
+Usage: python benchmark.py [--tasks N ...] [--lists N ...] [--outlines N ...] [--latency S] [--error-rate R]
+                           [--rate-limit-rate R] [--stages STAGE ...] [--save RESULTS.json] [--baseline RESULTS.json]
+--tasks sizes the whole account by its number of tasks. --lists and --outlines size the lists or the outlines
+only, e.g. to check that the time grows linearly from 10 to 10,000 lists. Without any sizes, --tasks 100 1000 10000 is run.
+With --baseline, stages that became slower than the tolerance allows are reported and the exit status is 1.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import logging
+import multiprocessing
+import metrics
+import mock_server
+
+SIZES = [100, 1000, 10000]
+# Sized item -> the account of the size and the stages that depend on the size by default
+ACCOUNTS = {
+    "tasks": (lambda n: mock_server.SyntheticAccount.scaled(n), None),
+    "lists": (lambda n: mock_server.SyntheticAccount(lists=n), ["lists"]),
+    "outlines": (lambda n: mock_server.SyntheticAccount(outlines=n), ["outlines"]),
+}
+DEFAULT_TOLERANCE = 0.25
+# Differences below this are noise, seconds
+MIN_REGRESSION_TIME = 0.5
+
+
+# Stage -> function of (backup module, access token, backup folder), in the order they run
+STAGES = {
+    "tasks": lambda b, token, path: b.get_raw_tasks(access_token=token, filename=path+"raw_tasks.csv",
+        page_size=b.DEFAULT_TASKS_PAGE_SIZE),
+    "folders": lambda b, token, path: b.get_and_backup_folders(access_token=token, filename=path+"folders.csv"),
+    "contexts": lambda b, token, path: b.get_and_backup_contexts(access_token=token, filename=path+"contexts.csv"),
+    "goals": lambda b, token, path: b.get_and_backup_goals(access_token=token, filename=path+"goals.csv"),
+    "locations": lambda b, token, path: b.get_and_backup_locations(access_token=token,
+        filename=path+"locations.csv"),
+    "notes": lambda b, token, path: b.get_and_backup_notes(access_token=token, filename=path+"notes.csv"),
+    "lists": lambda b, token, path: b.get_and_backup_lists(access_token=token, backup_path=path),
+    "outlines": lambda b, token, path: b.get_and_backup_outlines(access_token=token, backup_path=path),
+    # The raw tasks and the reference tables are read back from the backup folder, as a resumed run does
+    "merge": lambda b, token, path: b.merge_tasks(path, b.read_stage_result(path, "tasks"),
+        {i: b.read_stage_result(path, i) for i in b.REFERENCE_TABLES}),
+}
+
+
+def run_stage_process(stage, api_url, backup_path, retries, results):
+    """
+    Runs in a separate process: imports the backup code, points it to the mock API and runs the stage.
+    """
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.ERROR)
+    import backup
+    import client
+    backup.API_URL_PREFIX = api_url
+    client.configure(retries=retries)
+    start = time.perf_counter()
+    STAGES[stage](backup, "benchmark", backup_path)
+    results.put({"time": time.perf_counter()-start, "peak_rss_mb": metrics.peak_rss_bytes()/1024.0/1024.0})
+
+
+def run_stage(server, stage, backup_path, retries):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    before = server.totals()
+    process = context.Process(target=run_stage_process,
+            args=(stage, server.url, backup_path, retries, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError("Stage %s crashed with exit code %s" % (stage, process.exitcode))
+    process.join()
+    after = server.totals()
+    result["requests"] = after["requests"]-before["requests"]
+    result["bytes"] = after["bytes_sent"]-before["bytes_sent"]
+    return result
+
+
+def run_benchmarks(sizes, stages, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, retries=5, item="tasks"):
+    """
+    Returns "stage/size" -> results of the stage. The size is the number of tasks, or "lists=N" and
+    "outlines=N" for the other items.
+    """
+    results = {}
+    make_account = ACCOUNTS[item][0]
+    for size in sizes:
+        label = str(size) if item == "tasks" else "%s=%d" % (item, size)
+        server = mock_server.MockApiServer(make_account(size), latency=latency,
+                error_rate=error_rate, rate_limit_rate=rate_limit_rate, retry_after=0).start()
+        backup_path = tempfile.mkdtemp(prefix="toodledo_benchmark_")+os.path.sep
+        try:
+            for stage in stages:
+                result = run_stage(server, stage, backup_path, retries)
+                results[stage+"/"+label] = result
+                print("%-10s %14s %10.2f s %9d %12.1f MB %9.1f MB" % (stage, label, result["time"],
+                    result["requests"], result["bytes"]/1024.0/1024.0, result["peak_rss_mb"]))
+                sys.stdout.flush()
+        finally:
+            shutil.rmtree(backup_path)
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    regressions = []
+    for key in results:
+        if key not in baseline:
+            continue
+        old_time, new_time = baseline[key]["time"], results[key]["time"]
+        if new_time > old_time*(1+tolerance) and new_time-old_time > MIN_REGRESSION_TIME:
+            regressions.append("%s: %.2f s -> %.2f s" % (key, old_time, new_time))
+    return regressions
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the backup stages")
+    parser.add_argument("--tasks", type=int, nargs="+", help="Numbers of tasks in the accounts")
+    parser.add_argument("--lists", type=int, nargs="+", help="Numbers of lists, the rest of the account is small")
+    parser.add_argument("--outlines", type=int, nargs="+",
+            help="Numbers of outlines, the rest of the account is small")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES),
+            help="All of them for --tasks, only the sized item for --lists and --outlines by default")
+    parser.add_argument("--latency", type=float, default=0.0, help="Added to every response, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--save", help="Save the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the results saved earlier")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.ERROR)
+
+    if args.tasks is None and args.lists is None and args.outlines is None:
+        args.tasks = SIZES
+    print("%-10s %14s %12s %9s %15s %12s" % ("stage", "size", "wall time", "requests", "received", "peak RSS"))
+    results = {}
+    for item in ACCOUNTS:
+        if getattr(args, item) is not None:
+            results.update(run_benchmarks(getattr(args, item), args.stages or ACCOUNTS[item][1] or list(STAGES),
+                args.latency, args.error_rate, args.rate_limit_rate, args.retries, item))
+    if args.save:
+        with open(args.save, "wt") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "rt") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if len(regressions) > 0:
+            print("Regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No regressions")
@@ -0,0 +1,110 @@
+"""
+Command line entry point. Every command imports only what it needs, so e.g. refreshing the token
+does not load pandas, and a backup of some of the entities makes only their requests.
+
+Usage:
+    python cli.py backup [--tasks] [--notes] [--lists] [--outlines] [--reference] [--no-refresh]
+    python cli.py token [--write]
+    python cli.py restore|diff|snapshots|accounts|benchmark ARGUMENTS...
+The last ones run the command line of restore.py, diff_backups.py, snapshots.py, orchestrator.py
+and benchmark.py with the arguments; see those for the details.
+"""
+import os
+import sys
+import logging
+import argparse
+
+CUR_FILE_DIR = os.path.dirname(os.path.realpath(__file__))+os.path.sep
+CONFIG_FILENAME = CUR_FILE_DIR+"config.yaml"
+TOKEN_FILENAME = CUR_FILE_DIR+"token.txt"
+# Command -> module whose command line it runs
+MODULE_COMMANDS = {
+    "restore": "restore",
+    "diff": "diff_backups",
+    "snapshots": "snapshots",
+    "accounts": "orchestrator",
+    "benchmark": "benchmark",
+}
+# Entity flag -> backup stages
+ENTITY_FLAGS = {
+    "tasks": ["tasks"],
+    "notes": ["notes"],
+    "lists": ["lists"],
+    "outlines": ["outlines"],
+    "reference": ["folders", "contexts", "goals", "locations"],
+}
+
+
+def load_config(filename):
+    import yaml
+    with open(filename, "rt") as f:
+        return yaml.load(f, Loader=yaml.CLoader)
+
+
+def selected_entities(args):
+    """
+    Backup stages of the entity flags, None (everything) without flags.
+    """
+    entities = [stage for flag in ENTITY_FLAGS if getattr(args, flag) for stage in ENTITY_FLAGS[flag]]
+    return entities or None
+
+
+def run_backup(args):
+    import backup
+    report = backup.run_backup(load_config(args.config), args.token_file, entities=selected_entities(args),
+            refresh=not args.no_refresh)
+    return 1 if len(report["failed_stages"]) > 0 else 0
+
+
+def run_token(args):
+    import auth
+    config = load_config(args.config)
+    if args.write:
+        # Refreshed tokens keep the scopes they were authorized for, the write scope needs a new authorization
+        access_token, refresh_token = auth.get_tokens_from_scratch(config, auth.WRITE_SCOPES)
+    else:
+        access_token, refresh_token = auth.get_tokens(config, args.token_file)
+    auth.save_tokens(access_token, refresh_token, args.token_file)
+    return 0
+
+
+def run_module(name, arguments):
+    import runpy
+    sys.argv = [name+".py"]+arguments
+    runpy.run_module(name, run_name="__main__", alter_sys=True)
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Back up and restore ToodleDo accounts")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backup_parser = commands.add_parser("backup", help="Back up the account, all or some of the entities")
+    backup_parser.add_argument("--config", default=CONFIG_FILENAME)
+    backup_parser.add_argument("--token-file", default=TOKEN_FILENAME)
+    for flag in ENTITY_FLAGS:
+        backup_parser.add_argument("--"+flag, action="store_true",
+                help="Back up %s (everything if no entity is given)" % ", ".join(ENTITY_FLAGS[flag]))
+    backup_parser.add_argument("--no-refresh", action="store_true",
+            help="Use the saved tokens as they are, refresh them only when the API rejects them")
+
+    token_parser = commands.add_parser("token", help="Refresh the saved tokens, or authorize the account")
+    token_parser.add_argument("--config", default=CONFIG_FILENAME)
+    token_parser.add_argument("--token-file", default=TOKEN_FILENAME)
+    token_parser.add_argument("--write", action="store_true", help="Authorize the account again, to add items too (for restoring)")
+
+    # Listed for the help only: their arguments go to the module as they are, see __main__
+    for command in MODULE_COMMANDS:
+        commands.add_parser(command, add_help=False, help="Command line of %s.py" % MODULE_COMMANDS[command])
+    return parser
+
+
+if __name__=="__main__":
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.INFO)
+    # Not parsed here: argparse would take their options (e.g. --help) for its own
+    if len(sys.argv) > 1 and sys.argv[1] in MODULE_COMMANDS:
+        sys.exit(run_module(MODULE_COMMANDS[sys.argv[1]], sys.argv[2:]))
+    args = make_parser().parse_args()
+    if args.command == "backup":
+        sys.exit(run_backup(args))
+    sys.exit(run_token(args))
@@ -0,0 +1,269 @@
+"""
+Shared HTTP client for the ToodleDo API. All the requests go through one pooled keep-alive
+session, failed requests are retried with exponential backoff, the hourly request quota
+is enforced locally and an expired access token is refreshed on the fly.
+"""
+import email.utils
+import logging
+import random
+import threading
+import time
+import requests
+import metrics
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 120.0
+# Connect and read timeouts, seconds
+DEFAULT_TIMEOUT = (10, 300)
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+# Errors of reading a streamed body, e.g. the connection broke halfway through
+READ_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.ConnectionError, requests.Timeout)
+# None means no local limit
+DEFAULT_REQUESTS_PER_HOUR = None
+
+
+class TokenBucket:
+    """
+    Allows requests_per_hour requests on average, with bursts of up to capacity requests.
+    """
+    def __init__(self, requests_per_hour, capacity=None):
+        self.rate = requests_per_hour/3600.0
+        # By default a minute worth of requests can be spent at once
+        self.capacity = capacity if capacity is not None else max(1.0, requests_per_hour/60.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now-self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens)/self.rate
+            time.sleep(wait)
+
+
+max_concurrent_requests = DEFAULT_MAX_CONCURRENT_REQUESTS
+max_retries = DEFAULT_MAX_RETRIES
+request_slots = threading.BoundedSemaphore(DEFAULT_MAX_CONCURRENT_REQUESTS)
+rate_limiter = None
+token_refresher = None
+session = None
+session_lock = threading.Lock()
+token_lock = threading.Lock()
+# Access tokens that were refreshed -> their replacements
+replaced_tokens = {}
+# Set after 429 so that all the threads back off, not only the one that got it
+paused_until = 0.0
+
+
+def configure(max_concurrent=DEFAULT_MAX_CONCURRENT_REQUESTS, retries=DEFAULT_MAX_RETRIES,
+        requests_per_hour=DEFAULT_REQUESTS_PER_HOUR, refresher=None):
+    """
+    refresher is called with the rejected access token on 401. It should return a new access token,
+    or None if it could not get one.
+    """
+    global max_concurrent_requests, max_retries, request_slots, rate_limiter, token_refresher, session, \
+        replaced_tokens, paused_until
+    max_concurrent_requests = max_concurrent
+    max_retries = retries
+    request_slots = threading.BoundedSemaphore(max_concurrent)
+    rate_limiter = TokenBucket(requests_per_hour) if requests_per_hour else None
+    token_refresher = refresher
+    replaced_tokens = {}
+    paused_until = 0.0
+    with session_lock:
+        if session is not None:
+            session.close()
+        session = None
+
+
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_concurrent_requests)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        return session
+
+
+def get_retry_after(response):
+    """
+    Retry-After in seconds, either given as a number or as an HTTP date. None if missing.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt):
+    # "Full jitter", so that the threads that failed together do not retry together
+    return random.uniform(0, min(DEFAULT_BACKOFF_MAX, DEFAULT_BACKOFF_BASE*2**attempt))
+
+
+def wait_for_turn():
+    delay = paused_until - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+
+
+def current_token(access_token):
+    while access_token in replaced_tokens:
+        access_token = replaced_tokens[access_token]
+    return access_token
+
+
+def refresh_access_token(rejected_token):
+    """
+    Returns the access token to retry with, or None if there is nothing better than the rejected one.
+    """
+    with token_lock:
+        newer_token = current_token(rejected_token)
+        if newer_token != rejected_token:
+            # Somebody else has refreshed it already
+            return newer_token
+        if token_refresher is None:
+            return None
+        new_token = token_refresher(rejected_token)
+        if new_token is None or new_token == rejected_token:
+            return None
+        replaced_tokens[rejected_token] = new_token
+        logging.info("Access token refreshed after 401")
+        return new_token
+
+
+def hold_slot(response, slots):
+    """
+    The body of a streamed response is read after post returns. Its connection stays busy until then,
+    so the slot is released when the response is closed, not when the headers arrive.
+    """
+    close = response.close
+    released = []
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            if not released:
+                released.append(True)
+                slots.release()
+    response.close = close_and_release
+    return response
+
+
+def post(url, data, idempotent=True, refresh_on_401=True, **kwargs):
+    """
+    requests.post through the shared session. Waits for a free slot, so no more than
+    max_concurrent_requests requests are in flight, and for the rate limiter. Retries
+    429 (honouring Retry-After), 5xx and connection errors with backoff, and refreshes
+    the access token once on 401. Requests that are not idempotent are retried on 429 only.
+    Returns the last response; raises the last exception if no response was received.
+    A streamed response holds its slot until it is closed, so the caller must close it.
+    """
+    global paused_until
+    data = dict(data)
+    if "access_token" in data:
+        data["access_token"] = current_token(data["access_token"])
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    token_refreshed = False
+    attempt = 0
+    while True:
+        wait_for_turn()
+        slots = request_slots
+        slots.acquire()
+        try:
+            start = time.perf_counter()
+            response = get_session().post(url, data=data, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            slots.release()
+            metrics.observe_request(url, None, time.perf_counter()-start)
+            if attempt >= max_retries or not idempotent:
+                raise
+            metrics.observe_retry(url)
+            delay = get_backoff(attempt)
+            logging.warning("Request to %s failed: %s. Retrying in %.1f s", url, str(e), delay)
+            attempt += 1
+            time.sleep(delay)
+            continue
+        except BaseException:
+            slots.release()
+            raise
+        if kwargs.get("stream", False):
+            hold_slot(response, slots)
+        else:
+            slots.release()
+        # Streamed bodies are not read yet, their size is known from the header only
+        response_bytes = response.headers.get("Content-Length")
+        if response_bytes is not None:
+            response_bytes = int(response_bytes)
+        elif not kwargs.get("stream", False):
+            response_bytes = len(response.content)
+        metrics.observe_request(url, response.status_code, time.perf_counter()-start, response_bytes)
+
+        if response.status_code == 401 and refresh_on_401 and not token_refreshed \
+                and "access_token" in data:
+            new_token = refresh_access_token(data["access_token"])
+            token_refreshed = True
+            if new_token is not None:
+                response.close()
+                data["access_token"] = new_token
+                continue
+        retriable = response.status_code == 429 or \
+            (idempotent and response.status_code in RETRY_STATUS_CODES)
+        if not retriable or attempt >= max_retries:
+            return response
+
+        delay = get_retry_after(response)
+        if delay is None:
+            delay = get_backoff(attempt)
+        if response.status_code == 429:
+            paused_until = max(paused_until, time.monotonic()+delay)
+        logging.warning("Request to %s returned %d. Retrying in %.1f s",
+                url, response.status_code, delay)
+        response.close()
+        metrics.observe_retry(url)
+        attempt += 1
+        time.sleep(delay)
+
+
+def post_and_read(url, data, read, retry_on=READ_ERRORS, idempotent=True, **kwargs):
+    """
+    post with a streamed response, whose body is read with read(response). Retries only cover getting
+    the response, so if reading the body fails with one of retry_on, the request is sent again,
+    with the same backoff. Returns what read returns. The response is closed in any case.
+    """
+    attempt = 0
+    while True:
+        response = post(url, data, idempotent=idempotent, stream=True, **kwargs)
+        try:
+            return read(response)
+        except retry_on as e:
+            if attempt >= max_retries or not idempotent:
+                raise
+            metrics.observe_retry(url)
+            delay = get_backoff(attempt)
+            logging.warning("Reading the response of %s failed: %s. Retrying in %.1f s", url, str(e), delay)
+            attempt += 1
+        finally:
+            response.close()
+        # After the response is closed, so that it does not hold its slot
+        time.sleep(delay)
@@ -0,0 +1,193 @@
+"""
+Differences between two backup folders, e.g. last night's and tonight's: added, removed and changed
+records of every entity, matched by their ids. Records with "modified" (and "version") stamps are compared
+by the stamps only, the rest by a hash of their content. Tables are streamed in chunks. Big tables are
+partitioned by the hash of the key into temporary files first and compared partition by partition,
+so memory use stays bounded whatever the size of the tables.
+
+Usage: python diff_backups.py OLD_BACKUP_FOLDER NEW_BACKUP_FOLDER [--entities ENTITY ...] [--full]
+                              [--output CHANGES.jsonl]
+"""
+import os
+import sys
+import json
+import zlib
+import logging
+import argparse
+import tempfile
+import pandas as pd
+import storage
+import snapshots
+
+# Entity -> (table in the backup folder, columns that identify the record)
+DIFF_TABLES = dict(snapshots.SNAPSHOT_TABLES,
+                   list_cells=("lists_cells.csv", ["list_id", "row_id", "column_ids"]))
+STAMP_COLUMNS = ["modified", "version"]
+# Tables bigger than this are compared partition by partition
+PARTITION_SIZE_BYTES = 64*1024*1024
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+
+
+def find_table(filename):
+    """
+    Path of the table in the first configured format it is saved in, None if there is none.
+    """
+    for table_format in storage.backup_formats+[i for i in storage.ALL_FORMATS if i not in storage.backup_formats]:
+        path = storage.table_filename(filename, table_format)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def as_text(values):
+    return values.astype(object).where(values.notna(), "").astype(str)
+
+
+def iter_fingerprints(path, key_columns, columns, stamp_columns):
+    """
+    Yields (keys, fingerprints) per chunk of the table. The fingerprint is the stamps if there are
+    any, otherwise the hash of the content of the columns (missing ones are empty). Without the
+    columns the fingerprints are empty, only the keys are compared.
+    """
+    if path is None:
+        return
+    for chunk in storage.iter_table_chunks(path):
+        keys = as_text(chunk[key_columns[0]])
+        for column in key_columns[1:]:
+            keys = keys + "/" + as_text(chunk[column])
+        if len(stamp_columns) > 0:
+            fingerprints = as_text(chunk[stamp_columns[0]])
+            for column in stamp_columns[1:]:
+                fingerprints = fingerprints + "/" + as_text(chunk[column])
+        elif len(columns) > 0:
+            content = chunk.reindex(columns=columns).apply(as_text)
+            fingerprints = pd.util.hash_pandas_object(content, index=False).astype(str)
+        else:
+            fingerprints = pd.Series("", index=chunk.index)
+        yield keys.values, fingerprints.values
+
+
+def diff_items(old_items, new_items):
+    """
+    Yields (change, key) for the (key, fingerprint) pairs of the old and the new table.
+    """
+    old = dict(old_items)
+    for key, fingerprint in new_items:
+        old_fingerprint = old.pop(key, None)
+        if old_fingerprint is None:
+            yield ADDED, key
+        elif old_fingerprint != fingerprint:
+            yield CHANGED, key
+    for key in old:
+        yield REMOVED, key
+
+
+def iter_pairs(fingerprint_chunks):
+    for keys, fingerprints in fingerprint_chunks:
+        for pair in zip(keys, fingerprints):
+            yield pair
+
+
+def partition(fingerprint_chunks, files, n_partitions):
+    for keys, fingerprints in fingerprint_chunks:
+        df = pd.DataFrame({"key": keys, "fingerprint": fingerprints})
+        df["partition"] = [zlib.crc32(i.encode("utf-8")) % n_partitions for i in keys]
+        for i, part in df.groupby("partition"):
+            part[["key", "fingerprint"]].to_csv(files[i], header=False, index=False)
+
+
+def iter_partition(filename):
+    if os.path.getsize(filename) == 0:
+        return iter(())
+    df = pd.read_csv(filename, header=None, names=["key", "fingerprint"], dtype=str, keep_default_na=False)
+    return zip(df["key"].values, df["fingerprint"].values)
+
+
+def diff_table(old_filename, new_filename, key_columns, full=False, compare=True):
+    """
+    Yields (change, key) of the records of the table. With full set, the content is compared
+    even if there are stamps. Without compare, only the keys are.
+    """
+    old_path, new_path = find_table(old_filename), find_table(new_filename)
+    old_columns = storage.table_columns(old_path) if old_path is not None else []
+    new_columns = storage.table_columns(new_path) if new_path is not None else []
+    # If a table is missing, everything is either added or removed, there is nothing to compare
+    compare = compare and old_path is not None and new_path is not None
+    stamp_columns = []
+    if compare and not full and "modified" in old_columns and "modified" in new_columns:
+        stamp_columns = [i for i in STAMP_COLUMNS if i in old_columns and i in new_columns]
+    columns = sorted(set(old_columns) | set(new_columns)) if compare and len(stamp_columns) == 0 else []
+
+    old_chunks = iter_fingerprints(old_path, key_columns, columns, stamp_columns)
+    new_chunks = iter_fingerprints(new_path, key_columns, columns, stamp_columns)
+    size = max(os.path.getsize(i) if i is not None else 0 for i in [old_path, new_path])
+    n_partitions = 1 + size//PARTITION_SIZE_BYTES
+    if n_partitions == 1:
+        for change in diff_items(iter_pairs(old_chunks), iter_pairs(new_chunks)):
+            yield change
+        return
+    logging.info("Comparing %s in %d partitions", os.path.basename(old_filename), n_partitions)
+    with tempfile.TemporaryDirectory(prefix="toodledo_diff_") as temp_path:
+        filenames = {}
+        for side, chunks in [("old", old_chunks), ("new", new_chunks)]:
+            filenames[side] = [os.path.join(temp_path, "%s_%d.csv" % (side, i)) for i in range(n_partitions)]
+            files = [open(i, "wt", newline="") for i in filenames[side]]
+            try:
+                partition(chunks, files, n_partitions)
+            finally:
+                for f in files:
+                    f.close()
+        for i in range(n_partitions):
+            for change in diff_items(iter_partition(filenames["old"][i]), iter_partition(filenames["new"][i])):
+                yield change
+
+
+def diff_backups(old_backup_path, new_backup_path, entities=None, full=False):
+    """
+    Yields (entity, change, key) for all the entities (or the given ones) of the two backup folders.
+    """
+    for entity in entities or DIFF_TABLES:
+        filename, key_columns = DIFF_TABLES[entity]
+        for change, key in diff_table(old_backup_path+filename, new_backup_path+filename, key_columns, full):
+            yield entity, change, key
+
+
+def find_missing_keys(filename, reference_filename, key_columns):
+    """
+    Keys of the reference table that the table does not have, e.g. to check that nothing was lost
+    when a table was made from another one.
+    """
+    return [key for change, key in diff_table(reference_filename, filename, key_columns, compare=False)
+            if change == REMOVED]
+
+
+if __name__=="__main__":
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Differences between two ToodleDo backups")
+    parser.add_argument("old_backup_folder")
+    parser.add_argument("new_backup_folder")
+    parser.add_argument("--entities", nargs="+", choices=list(DIFF_TABLES))
+    parser.add_argument("--full", action="store_true",
+            help="Compare the content of the records even if their modification stamps are the same")
+    parser.add_argument("--output", help="Write every change to this file as a JSON line")
+    args = parser.parse_args()
+
+    old_backup_path = os.path.normpath(args.old_backup_folder)+os.path.sep
+    new_backup_path = os.path.normpath(args.new_backup_folder)+os.path.sep
+    counts = {}
+    output = open(args.output, "wt") if args.output else None
+    try:
+        for entity, change, key in diff_backups(old_backup_path, new_backup_path, args.entities, args.full):
+            counts.setdefault(entity, {ADDED: 0, REMOVED: 0, CHANGED: 0})[change] += 1
+            if output is not None:
+                output.write(json.dumps({"entity": entity, "change": change, "key": key})+"\n")
+    finally:
+        if output is not None:
+            output.close()
+    print("%-14s %10s %10s %10s" % ("entity", ADDED, REMOVED, CHANGED))
+    for entity in counts:
+        print("%-14s %10d %10d %10d" % (entity, counts[entity][ADDED], counts[entity][REMOVED],
+                                        counts[entity][CHANGED]))
+    sys.exit(1 if len(counts) > 0 else 0)
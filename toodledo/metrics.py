@@ -0,0 +1,233 @@
+"""
+Run metrics: request latencies and statuses per endpoint, response sizes, retries, rows and write
+times per table, stage durations and outcomes (including the fetches that failed without stopping
+the stage) and the memory high-water mark. Saved at the end of the run as a JSON
+report and, optionally, as a Prometheus textfile (for the node_exporter textfile collector).
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+import urllib.parse
+
+# Upper bounds of the latency histogram buckets, seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+PROMETHEUS_PREFIX = "toodledo_backup_"
+
+lock = threading.Lock()
+started = time.time()
+requests = {}
+retries = {}
+tables = {}
+stages = {}
+failures = {}
+
+
+def reset():
+    global started, requests, retries, tables, stages, failures
+    with lock:
+        started = time.time()
+        requests = {}
+        retries = {}
+        tables = {}
+        stages = {}
+        failures = {}
+
+
+def peak_rss_bytes():
+    """
+    Memory high-water mark of the process, None where it is not available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak*1024
+
+
+def endpoint_name(url):
+    path = urllib.parse.urlsplit(url).path
+    return re.sub(r"^/\d+/", "", path)
+
+
+def table_name(filename):
+    """
+    Per-item tables (lists, outlines) are counted together: rows_list_123.csv -> rows_list_*.csv
+    """
+    return re.sub(r"_\d+\.", "_*.", os.path.basename(filename))
+
+
+def observe_request(url, status_code, seconds, response_bytes=None):
+    """
+    status_code is None if no response was received.
+    """
+    endpoint = endpoint_name(url)
+    with lock:
+        stats = requests.setdefault(endpoint, {"count": 0, "seconds": 0.0, "bytes": 0, "statuses": {},
+                                               "buckets": [0]*(len(LATENCY_BUCKETS)+1)})
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        if response_bytes is not None:
+            stats["bytes"] += response_bytes
+        status = str(status_code) if status_code is not None else "error"
+        stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        stats["buckets"][bucket] += 1
+
+
+def observe_retry(url):
+    endpoint = endpoint_name(url)
+    with lock:
+        retries[endpoint] = retries.get(endpoint, 0) + 1
+
+
+def observe_table(filename, rows, seconds):
+    """
+    Called when a table is saved: rows written and time spent writing them.
+    """
+    name = table_name(filename)
+    with lock:
+        stats = tables.setdefault(name, {"count": 0, "rows": 0, "seconds": 0.0, "empty": 0})
+        stats["count"] += 1
+        stats["rows"] += rows
+        stats["seconds"] += seconds
+        if rows == 0:
+            stats["empty"] += 1
+
+
+def observe_failure(stage, reason):
+    """
+    Called when a fetch of the stage fails and the stage goes on without it (e.g. keeps the previous
+    backup), so that the stage is reported as failed even though it did not raise.
+    """
+    with lock:
+        stats = failures.setdefault(stage, {"count": 0, "first": reason})
+        stats["count"] += 1
+
+
+def has_failures(stage):
+    with lock:
+        return stage in failures
+
+
+class Stage:
+    """
+    Context manager that times a stage and records whether it succeeded. Stages run concurrently,
+    so the memory high-water mark recorded at the end of a stage is that of the whole process.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record_stage(self.name, time.perf_counter()-self.start, exc_type is None)
+
+
+def record_stage(name, seconds, succeeded=True):
+    with lock:
+        stages[name] = {"seconds": seconds, "succeeded": succeeded and name not in failures,
+                        "peak_rss_bytes": peak_rss_bytes()}
+
+
+def get_report():
+    with lock:
+        report = {
+            "started": started,
+            "finished": time.time(),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "latency_buckets": LATENCY_BUCKETS,
+            "stages": json.loads(json.dumps(stages)),
+            "requests": json.loads(json.dumps(requests)),
+            "retries": dict(retries),
+            "tables": json.loads(json.dumps(tables)),
+            "failures": json.loads(json.dumps(failures)),
+        }
+    # An empty delta only means that nothing has changed
+    report["empty_tables"] = sorted(i for i in report["tables"]
+                                    if report["tables"][i]["rows"] == 0 and ".delta." not in i)
+    report["failed_stages"] = sorted(set(i for i in report["stages"] if not report["stages"][i]["succeeded"])
+                                     | set(report["failures"]))
+    return report
+
+
+def save_report(filename):
+    # Not imported at the top: storage loads pandas, which the token refresh alone does not need
+    import storage
+    report = get_report()
+    # A half-written report must not be picked up by whoever reads it
+    storage.write_atomically(filename, json.dumps(report, indent=2))
+    if len(report["empty_tables"]) > 0:
+        logging.warning("Empty tables in this run: %s", ", ".join(report["empty_tables"]))
+    logging.info("Saved run report to %s", filename)
+    return report
+
+
+def label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_prometheus(report):
+    lines = []
+
+    def header(name, metric_type, help_text):
+        lines.append("# HELP %s%s %s" % (PROMETHEUS_PREFIX, name, help_text))
+        lines.append("# TYPE %s%s %s" % (PROMETHEUS_PREFIX, name, metric_type))
+
+    def sample(name, labels, value):
+        labels_text = ",".join('%s="%s"' % (k, label(v)) for k, v in labels)
+        lines.append("%s%s%s %r" % (PROMETHEUS_PREFIX, name, "{"+labels_text+"}" if labels_text else "",
+                                    float(value)))
+
+    def metric(name, metric_type, help_text, samples):
+        header(name, metric_type, help_text)
+        for labels, value in samples:
+            sample(name, labels, value)
+
+    metric("last_run_timestamp_seconds", "gauge", "End of the last backup run.", [((), report["finished"])])
+    metric("run_duration_seconds", "gauge", "Duration of the last backup run.",
+        [((), report["finished"]-report["started"])])
+    if report["peak_rss_bytes"] is not None:
+        metric("peak_rss_bytes", "gauge", "Memory high-water mark of the run.", [((), report["peak_rss_bytes"])])
+    metric("stage_duration_seconds", "gauge", "Duration of the stage.",
+        [((("stage", i),), report["stages"][i]["seconds"]) for i in sorted(report["stages"])])
+    metric("stage_succeeded", "gauge", "1 if the stage succeeded.",
+        [((("stage", i),), int(report["stages"][i]["succeeded"])) for i in sorted(report["stages"])])
+    metric("fetch_failures_total", "counter", "Failed fetches the stage went on without.",
+        [((("stage", i),), report["failures"][i]["count"]) for i in sorted(report["failures"])])
+    header("request_duration_seconds", "histogram", "Latency of the API requests.")
+    for endpoint in sorted(report["requests"]):
+        stats = report["requests"][endpoint]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS+["+Inf"], stats["buckets"]):
+            cumulative += count
+            sample("request_duration_seconds_bucket", (("endpoint", endpoint), ("le", bound)), cumulative)
+        sample("request_duration_seconds_sum", (("endpoint", endpoint),), stats["seconds"])
+        sample("request_duration_seconds_count", (("endpoint", endpoint),), stats["count"])
+    metric("requests_total", "counter", "API requests by response status.",
+        [((("endpoint", i), ("status", status)), count) for i in sorted(report["requests"])
+         for status, count in sorted(report["requests"][i]["statuses"].items())])
+    metric("response_bytes_total", "counter", "Size of the API responses.",
+        [((("endpoint", i),), report["requests"][i]["bytes"]) for i in sorted(report["requests"])])
+    metric("retries_total", "counter", "Retried API requests.",
+        [((("endpoint", i),), report["retries"][i]) for i in sorted(report["retries"])])
+    metric("table_rows", "gauge", "Rows saved to the table.",
+        [((("table", i),), report["tables"][i]["rows"]) for i in sorted(report["tables"])])
+    metric("table_write_seconds", "gauge", "Time spent writing the table.",
+        [((("table", i),), report["tables"][i]["seconds"]) for i in sorted(report["tables"])])
+    return "\n".join(lines)+"\n"
+
+
+def save_prometheus(filename, report=None):
+    import storage
+    storage.write_atomically(filename, format_prometheus(report if report is not None else get_report()))
+    logging.info("Saved Prometheus metrics to %s", filename)
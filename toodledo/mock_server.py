@@ -0,0 +1,353 @@
+"""
+Local stand-in for the ToodleDo API v3, used by the offline benchmarks. It serves a synthetic
+account whose items are generated from their numbers on every request, so an account of a million
+tasks takes no memory. It supports start/num pagination, "after" filtering, injected latency,
+server errors (500) and rate limiting (429 with Retry-After). Items sent to add.php and edit.php
+get new ids and are counted, but not stored.
+
+Usage: python mock_server.py [number of tasks] [port]
+"""
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+API_PATH_PREFIX = "/3/"
+# The API returns at most 1000 tasks or notes per request
+MAX_PAGE_SIZE = 1000
+FIRST_STAMP = 1600000000
+TASK_FIELDS = {
+    "folder": lambda a, i: i % a.folders + 1 if a.folders > 0 else 0,
+    "context": lambda a, i: i % a.contexts + 1 if a.contexts > 0 else 0,
+    "goal": lambda a, i: i % a.goals + 1 if a.goals > 0 else 0,
+    "location": lambda a, i: i % a.locations + 1 if a.locations > 0 else 0,
+    "tag": lambda a, i: "tag%d" % (i % 7) if i % 3 == 0 else "",
+    "startdate": lambda a, i: 0,
+    "duedate": lambda a, i: FIRST_STAMP + 86400*(i % 30) if i % 4 == 0 else 0,
+    "duedatemod": lambda a, i: 0,
+    "starttime": lambda a, i: 0,
+    "duetime": lambda a, i: 0,
+    "remind": lambda a, i: 0,
+    "repeat": lambda a, i: "",
+    "status": lambda a, i: i % 11,
+    "star": lambda a, i: int(i % 5 == 0),
+    "priority": lambda a, i: i % 4 - 1,
+    "length": lambda a, i: 15*(i % 4),
+    "timer": lambda a, i: 0,
+    "added": lambda a, i: FIRST_STAMP,
+    "note": lambda a, i: "Note of task %d" % i if i % 2 == 0 else "",
+    "parent": lambda a, i: 0,
+    "children": lambda a, i: 0,
+    "order": lambda a, i: i,
+    "meta": lambda a, i: "",
+    "previous": lambda a, i: 0,
+    "attachment": lambda a, i: [],
+    "shared": lambda a, i: 0,
+    "addedby": lambda a, i: 0,
+    "via": lambda a, i: "",
+    "attachments": lambda a, i: [],
+}
+
+
+class SyntheticAccount:
+    """
+    Item number i (from 0) has id i+1 and was modified at FIRST_STAMP+i, so "after" and
+    start/num windows map to ranges of numbers without generating the skipped items.
+    """
+    def __init__(self, tasks=100, notes=10, folders=10, contexts=5, goals=5, locations=5,
+            lists=5, cols_per_list=4, rows_per_list=20, outlines=5, nodes_per_outline=20):
+        self.tasks = tasks
+        self.notes = notes
+        self.folders = folders
+        self.contexts = contexts
+        self.goals = goals
+        self.locations = locations
+        self.lists = lists
+        self.cols_per_list = cols_per_list
+        self.rows_per_list = rows_per_list
+        self.outlines = outlines
+        self.nodes_per_outline = nodes_per_outline
+
+    @classmethod
+    def scaled(cls, tasks):
+        """
+        An account of the given number of tasks, with the rest of the items in a typical proportion.
+        """
+        return cls(tasks=tasks, notes=tasks//10, folders=min(100, 1+tasks//100),
+            contexts=min(30, 1+tasks//1000), goals=min(30, 1+tasks//1000),
+            locations=min(30, 1+tasks//1000), lists=max(1, tasks//1000),
+            outlines=max(1, tasks//1000))
+
+    def task(self, i, fields):
+        result = {"id": i+1, "title": "Task %d" % i, "modified": FIRST_STAMP+i,
+                  "completed": FIRST_STAMP+i if i % 3 == 0 else 0}
+        for field in fields:
+            if field in TASK_FIELDS:
+                result[field] = TASK_FIELDS[field](self, i)
+        return result
+
+    def note(self, i):
+        return {"id": i+1, "title": "Note %d" % i, "modified": FIRST_STAMP+i, "added": FIRST_STAMP,
+                "folder": i % self.folders + 1 if self.folders > 0 else 0, "private": 0,
+                "text": "Text of note %d. " % i * 5}
+
+    def info(self):
+        """
+        Account info. The last edit of a reference table moves with the number of its items.
+        """
+        return {"userid": "mock%d" % self.tasks, "alias": "mock", "pro": 1, "dateformat": 0,
+                "timezone": 0, "hidemonths": 0, "hotlistpriority": 3, "hotlistduedate": 2,
+                "showtabnums": 1, "lastedit_folder": FIRST_STAMP+self.folders,
+                "lastedit_context": FIRST_STAMP+self.contexts, "lastedit_goal": FIRST_STAMP+self.goals,
+                "lastedit_location": FIRST_STAMP+self.locations,
+                "lastedit_task": FIRST_STAMP+self.tasks, "lastdelete_task": FIRST_STAMP,
+                "lastedit_note": FIRST_STAMP+self.notes, "lastdelete_note": FIRST_STAMP,
+                "lastedit_list": FIRST_STAMP+self.lists, "lastedit_outline": FIRST_STAMP+self.outlines}
+
+    def folder(self, i):
+        return {"id": i+1, "name": "Folder %d" % i, "private": 0, "archived": int(i % 10 == 9), "ord": i}
+
+    def context(self, i):
+        return {"id": i+1, "name": "Context %d" % i, "private": 0}
+
+    def goal(self, i):
+        return {"id": i+1, "name": "Goal %d" % i, "level": i % 3, "archived": 0,
+                "contributes": 0, "note": ""}
+
+    def location(self, i):
+        return {"id": i+1, "name": "Location %d" % i, "description": "", "lat": 51.5+i/1000.0,
+                "lon": -0.1+i/1000.0}
+
+    def list(self, i):
+        return {"id": i+1, "added": FIRST_STAMP, "modified": FIRST_STAMP+i, "title": "List %d" % i,
+                "version": 1, "note": "", "keywords": "", "rows": self.rows_per_list,
+                "cols": [{"id": (i+1)*100+j, "title": "Column %d" % j, "type": 1, "sort": 0, "width": 100}
+                         for j in range(self.cols_per_list)]}
+
+    def rows(self, list_id):
+        return [{"id": list_id*100000+k, "added": FIRST_STAMP, "modified": FIRST_STAMP, "version": 1,
+                 "list": list_id,
+                 "cells": {"c"+str(j+1): "Value %d %d" % (k, j) for j in range(self.cols_per_list)}}
+                for k in range(self.rows_per_list)]
+
+    def outline(self, i):
+        return {"id": i+1, "added": FIRST_STAMP, "modified": FIRST_STAMP+i, "title": "Outline %d" % i,
+                "hidden": 0, "version": 1, "note": "", "keywords": "",
+                "outline": {"count": self.nodes_per_outline, "updated_at": FIRST_STAMP+i,
+                            "children": [{"id": "n%d_%d" % (i+1, k), "title": "Node %d" % k,
+                                          "type": "task", "completed": 0}
+                                         for k in range(self.nodes_per_outline)]}}
+
+
+def changed_range(count, after):
+    """
+    Numbers of the items modified after the stamp.
+    """
+    first = 0 if after is None else max(0, int(after)-FIRST_STAMP+1)
+    return range(min(first, count), count)
+
+
+def paged(items, params):
+    """
+    Window of the item numbers per start/num, with num/total as the first element.
+    """
+    start = int(params.get("start", 0))
+    num = min(int(params.get("num", MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+    page = items[start:start+num]
+    return page, {"num": len(page), "total": len(items)}
+
+
+def get_response(account, endpoint, params):
+    """
+    Body of the response to the endpoint, as a JSON-serialisable object. None for unknown endpoints.
+    """
+    after = params.get("after")
+    if endpoint == "account/get.php":
+        return account.info()
+    if endpoint == "tasks/get.php":
+        page, summary = paged(changed_range(account.tasks, after), params)
+        fields = params.get("fields", "").split(",")
+        return [summary] + [account.task(i, fields) for i in page]
+    if endpoint == "notes/get.php":
+        page, summary = paged(changed_range(account.notes, after), params)
+        return [summary] + [account.note(i) for i in page]
+    if endpoint in ("tasks/deleted.php", "notes/deleted.php", "lists/deleted.php", "outlines/deleted.php"):
+        return [{"num": 0}]
+    if endpoint == "folders/get.php":
+        return [account.folder(i) for i in range(account.folders)]
+    if endpoint == "contexts/get.php":
+        return [account.context(i) for i in range(account.contexts)]
+    if endpoint == "goals/get.php":
+        return [account.goal(i) for i in range(account.goals)]
+    if endpoint == "locations/get.php":
+        return [account.location(i) for i in range(account.locations)]
+    if endpoint == "lists/get.php":
+        return [account.list(i) for i in changed_range(account.lists, after)]
+    if endpoint == "rows/get.php":
+        list_id = int(params.get("list", 0))
+        return account.rows(list_id) if 0 < list_id <= account.lists else []
+    if endpoint == "outlines/get.php":
+        return [account.outline(i) for i in changed_range(account.outlines, after)]
+    return None
+
+
+class MockApiServer(ThreadingHTTPServer):
+    """
+    Serves the account at http://host:port/3/. latency (seconds) is added to every response,
+    error_rate and rate_limit_rate are the shares of the requests answered with 500 and 429.
+    failing_endpoints (e.g. "rows/get.php") always answer 500. cut_responses maps the endpoint to the number
+    of its next responses whose body is cut halfway through by closing the connection.
+    Counts the requests and bytes per endpoint.
+    """
+    daemon_threads = True
+
+    def __init__(self, account, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0,
+            rate_limit_rate=0.0, retry_after=1, seed=0, failing_endpoints=()):
+        super().__init__((host, port), MockApiHandler)
+        self.account = account
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.failing_endpoints = set(failing_endpoints)
+        self.cut_responses = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.last_added_id = 10**9
+        self.added = {}
+
+    @property
+    def url(self):
+        return "http://%s:%d%s" % (self.server_address[0], self.server_address[1], API_PATH_PREFIX)
+
+    def choose_failure(self, endpoint):
+        if endpoint in self.failing_endpoints:
+            return 500
+        with self.lock:
+            value = self.random.random()
+        if value < self.error_rate:
+            return 500
+        if value < self.error_rate + self.rate_limit_rate:
+            return 429
+        return None
+
+    def cut_response(self, endpoint):
+        """
+        True if the response to the endpoint is to be cut.
+        """
+        with self.lock:
+            if self.cut_responses.get(endpoint, 0) <= 0:
+                return False
+            self.cut_responses[endpoint] -= 1
+            return True
+
+    def count(self, endpoint, status_code, bytes_received, bytes_sent):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, {"requests": 0, "bytes_received": 0, "bytes_sent": 0,
+                                                     "statuses": {}})
+            stats["requests"] += 1
+            stats["bytes_received"] += bytes_received
+            stats["bytes_sent"] += bytes_sent
+            stats["statuses"][status_code] = stats["statuses"].get(status_code, 0) + 1
+
+    def add_items(self, endpoint, params):
+        """
+        Response of add.php and edit.php: the items with new ids (add) or as they were sent (edit).
+        Reference tables take one item as parameters, the rest take a JSON array of items.
+        """
+        entity, action = endpoint.split("/")
+        if entity in params:
+            items = json.loads(params[entity])
+        else:
+            items = [{k: v for k, v in params.items() if k != "access_token"}]
+        with self.lock:
+            for item in items:
+                if action == "add.php":
+                    self.last_added_id += 1
+                    item["id"] = self.last_added_id
+            self.added[endpoint] = self.added.get(endpoint, 0) + len(items)
+        return items
+
+    def totals(self):
+        """
+        Requests, bytes received and bytes sent over all the endpoints.
+        """
+        with self.lock:
+            return {i: sum(j[i] for j in self.stats.values())
+                    for i in ["requests", "bytes_received", "bytes_sent"]}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(body.decode("utf-8")).items()}
+        params.update({k: v[-1] for k, v in
+                       urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).items()})
+        self.respond(urllib.parse.urlsplit(self.path).path, params, len(body))
+
+    def do_GET(self):
+        split_path = urllib.parse.urlsplit(self.path)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(split_path.query).items()}
+        self.respond(split_path.path, params, 0)
+
+    def respond(self, path, params, bytes_received):
+        server = self.server
+        endpoint = path[len(API_PATH_PREFIX):] if path.startswith(API_PATH_PREFIX) else path
+        if server.latency > 0:
+            time.sleep(server.latency)
+        headers = {}
+        status_code = server.choose_failure(endpoint)
+        if status_code == 500:
+            result = {"errorCode": 500, "errorDesc": "Injected server error"}
+        elif status_code == 429:
+            result = {"errorCode": 429, "errorDesc": "Injected rate limit"}
+            headers["Retry-After"] = str(server.retry_after)
+        else:
+            if endpoint.endswith("/add.php") or endpoint.endswith("/edit.php"):
+                result = server.add_items(endpoint, params)
+            else:
+                result = get_response(server.account, endpoint, params)
+            status_code = 200
+            if result is None:
+                status_code = 404
+                result = {"errorCode": 404, "errorDesc": "Unknown endpoint " + endpoint}
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name in headers:
+            self.send_header(name, headers[name])
+        self.end_headers()
+        if status_code == 200 and server.cut_response(endpoint):
+            body = body[:len(body)//2]
+            self.close_connection = True
+        self.wfile.write(body)
+        server.count(endpoint, status_code, bytes_received, len(body))
+
+    def log_message(self, format, *args):
+        logging.debug("Mock API: " + format, *args)
+
+
+if __name__=="__main__":
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.INFO)
+    n_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    server = MockApiServer(SyntheticAccount.scaled(n_tasks), port=port)
+    logging.info("Serving a synthetic account of %d tasks at %s", n_tasks, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,155 @@
+"""
+Backs up several ToodleDo accounts at once. Every account has its own settings, token file and
+backup folder, and is backed up in a separate process, so the accounts do not share the API client,
+its request limits or the tokens. At most MAX_PARALLEL_ACCOUNTS accounts are backed up at a time.
+The status of every account goes to the aggregated report.
+
+The accounts file is described in accounts_template.yaml: settings shared by the accounts, the same as
+in config.yaml, and the accounts with their own names, backup folders, token files and overrides of the settings.
+Relative paths are relative to the folder of the accounts file. Accounts without tokens are authorized
+one by one, interactively, before the backups start.
+
+Usage: python orchestrator.py ACCOUNTS_FILE [--accounts NAME ...] [--report REPORT.json]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+import auth
+import backup
+
+MAX_PARALLEL_ACCOUNTS_FIELD = 'MAX_PARALLEL_ACCOUNTS'
+DEFAULTS_FIELD = 'DEFAULTS'
+ACCOUNTS_FIELD = 'ACCOUNTS'
+NAME_FIELD = 'NAME'
+TOKEN_FILE_FIELD = 'TOKEN_FILE'
+DEFAULT_MAX_PARALLEL_ACCOUNTS = 4
+DEFAULT_REPORT_FILENAME = 'accounts_report.json'
+
+
+def load_accounts(accounts_filename):
+    """
+    Returns the settings of the file and the list of the account configs, with absolute paths.
+    """
+    with open(accounts_filename, "rt") as f:
+        settings = yaml.load(f, Loader=yaml.CLoader)
+    base_path = os.path.dirname(os.path.abspath(accounts_filename))
+    # The accounts would overwrite each other's backups and tokens
+    for field in [backup.BACKUP_FOLDER_FIELD, TOKEN_FILE_FIELD]:
+        if field in settings.get(DEFAULTS_FIELD, {}):
+            raise ValueError("%s cannot be shared, set it for every account instead" % field)
+    accounts = []
+    for i, account in enumerate(settings.get(ACCOUNTS_FIELD, [])):
+        config = dict(settings.get(DEFAULTS_FIELD, {}))
+        config.update(account)
+        config.setdefault(NAME_FIELD, "account%d" % (i+1))
+        config.setdefault(TOKEN_FILE_FIELD, "token_%s.txt" % config[NAME_FIELD])
+        if backup.BACKUP_FOLDER_FIELD not in config:
+            raise ValueError("Account %s has no %s" % (config[NAME_FIELD], backup.BACKUP_FOLDER_FIELD))
+        for field in [backup.BACKUP_FOLDER_FIELD, TOKEN_FILE_FIELD]:
+            config[field] = os.path.normpath(os.path.join(base_path, config[field]))+ \
+                (os.path.sep if field == backup.BACKUP_FOLDER_FIELD else "")
+        accounts.append(config)
+    for field in [NAME_FIELD, backup.BACKUP_FOLDER_FIELD, TOKEN_FILE_FIELD]:
+        values = [i[field] for i in accounts]
+        if len(set(values)) != len(values):
+            raise ValueError("Every account needs its own %s: %s" % (field, values))
+    return settings, accounts
+
+
+def authorize_missing(accounts):
+    """
+    Asks the user to authorize the accounts that have no tokens yet. Done before the backups start,
+    as the backup processes cannot ask.
+    """
+    for config in accounts:
+        if not os.path.isfile(config[TOKEN_FILE_FIELD]):
+            print("Authorize account %s" % config[NAME_FIELD])
+            os.makedirs(os.path.dirname(config[TOKEN_FILE_FIELD]), exist_ok=True)
+            access_token, refresh_token = auth.get_tokens(config, config[TOKEN_FILE_FIELD])
+            auth.save_tokens(access_token, refresh_token, config[TOKEN_FILE_FIELD])
+
+
+def backup_account(config):
+    """
+    Runs in a separate process. Returns the status of the account, never raises.
+    """
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-' + config[NAME_FIELD] + '-%(message)s',
+            level=logging.INFO, force=True)
+    start = time.time()
+    status = {"account": config[NAME_FIELD], "backup_folder": config[backup.BACKUP_FOLDER_FIELD], "started": start}
+    try:
+        report = backup.run_backup(config, config[TOKEN_FILE_FIELD], interactive=False)
+        # Failed fetches do not raise, the stages they belong to are reported as failed
+        status["failed_stages"] = report["failed_stages"]
+        status["failures"] = report["failures"]
+        status["empty_tables"] = report["empty_tables"]
+        status["requests"] = sum(i["count"] for i in report["requests"].values())
+        status["peak_rss_bytes"] = report["peak_rss_bytes"]
+        status["status"] = "failed" if len(report["failed_stages"]) > 0 else "ok"
+    except Exception as e:
+        logging.error("Backup failed: %s\n%s", str(e), traceback.format_exc())
+        status["status"] = "failed"
+        status["error"] = str(e)
+    status["seconds"] = time.time()-start
+    return status
+
+
+def run_accounts(accounts, max_parallel=DEFAULT_MAX_PARALLEL_ACCOUNTS):
+    """
+    Backs up the accounts, at most max_parallel at a time. Returns their statuses.
+    """
+    statuses = []
+    # Spawned workers do not inherit the state of this process. A worker backs up several accounts
+    # in turn: run_backup sets up the global state of the modules (client, metrics, formats) for each one.
+    with ProcessPoolExecutor(max_workers=max(1, min(max_parallel, len(accounts))),
+            mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(backup_account, i) for i in accounts]
+        for config, future in zip(accounts, futures):
+            try:
+                statuses.append(future.result())
+            except Exception as e:
+                # The process died, e.g. out of memory
+                statuses.append({"account": config[NAME_FIELD], "status": "failed", "error": str(e)})
+            logging.info("Account %s: %s", statuses[-1]["account"], statuses[-1]["status"])
+    return statuses
+
+
+def make_report(statuses):
+    return {
+        "finished": time.time(),
+        "accounts": len(statuses),
+        "failed": sorted(i["account"] for i in statuses if i["status"] != "ok"),
+        "statuses": statuses,
+    }
+
+
+if __name__=="__main__":
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Back up several ToodleDo accounts")
+    parser.add_argument("accounts_file")
+    parser.add_argument("--accounts", nargs="+", help="Back up only these accounts")
+    parser.add_argument("--report", help="Aggregated report, %s next to the accounts file by default"
+            % DEFAULT_REPORT_FILENAME)
+    args = parser.parse_args()
+
+    settings, accounts = load_accounts(args.accounts_file)
+    if args.accounts:
+        accounts = [i for i in accounts if i[NAME_FIELD] in args.accounts]
+    authorize_missing(accounts)
+    statuses = run_accounts(accounts, settings.get(MAX_PARALLEL_ACCOUNTS_FIELD, DEFAULT_MAX_PARALLEL_ACCOUNTS))
+    report = make_report(statuses)
+    report_filename = args.report or os.path.join(os.path.dirname(os.path.abspath(args.accounts_file)),
+            DEFAULT_REPORT_FILENAME)
+    with open(report_filename, "wt") as f:
+        json.dump(report, f, indent=2)
+    for i in statuses:
+        print("%-20s %-7s %8.1f s %s" % (i["account"], i["status"], i.get("seconds", 0),
+            i.get("error", ", ".join(i.get("failed_stages", [])))))
+    sys.exit(1 if len(report["failed"]) > 0 else 0)
@@ -0,0 +1,123 @@
+"""
+Cache of the reference tables: folders, contexts, goals and locations. They are small and rarely change,
+so instead of fetching them every run, the backup checks their "lastedit" stamps in the account info
+(account/get.php, one request for all four) and fetches only the tables whose stamp moved since they
+were saved. The stamps are kept in the backup folder per account, along with the checksums of the saved
+tables. Parsed tables and their id -> name indexes are also kept in the process, for the runs that follow.
+"""
+import os
+import json
+import logging
+import threading
+import pandas as pd
+import storage
+import run_journal
+
+REFERENCE_CACHE_FILENAME = 'reference_cache.json'
+# Table -> its stamp in the account info
+LASTEDIT_FIELDS = {
+    "folders": "lastedit_folder",
+    "contexts": "lastedit_context",
+    "goals": "lastedit_goal",
+    "locations": "lastedit_location",
+}
+
+# (backup path, formats, account, table) -> (lastedit, table, id -> name), parsed in this process
+parsed_tables = {}
+parsed_tables_lock = threading.Lock()
+
+
+def build_name_index(df):
+    """
+    id -> name of a reference table: folders, contexts, goals or locations.
+    """
+    if df is None or len(df) == 0:
+        return pd.Series(dtype=object)
+    df = df.drop_duplicates("id")
+    return pd.Series(df["name"].values, index=pd.to_numeric(df["id"], errors="coerce"))
+
+
+class ReferenceCache:
+    """
+    Stamps of the reference tables saved in the backup folder, for the account of account_info.
+    Without the account info (e.g. it could not be fetched) nothing is fresh, and nothing is recorded.
+    """
+    def __init__(self, backup_path, account_info):
+        self.backup_path = backup_path
+        self.filename = backup_path+REFERENCE_CACHE_FILENAME
+        self.account = str(account_info.get("userid")) if account_info is not None else None
+        self.account_info = account_info or {}
+        self.lock = threading.Lock()
+        self.accounts = self.load()
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        try:
+            with open(self.filename, "rt") as f:
+                return json.load(f)
+        except ValueError as e:
+            logging.warning("Failed to read the reference cache %s: %s. Fetching all the tables.",
+                    self.filename, str(e))
+            return {}
+
+    def save(self):
+        storage.write_atomically(self.filename, json.dumps(self.accounts, indent=2))
+
+    def lastedit(self, table):
+        return self.account_info.get(LASTEDIT_FIELDS[table])
+
+    def key(self, table):
+        return (self.backup_path, tuple(storage.backup_formats), self.account, table)
+
+    def is_fresh(self, table, filenames):
+        """
+        True if the table has not been edited since it was saved, and the saved files are intact.
+        They must be saved in the current formats: a format added since then has no files yet.
+        """
+        if self.account is None or self.lastedit(table) is None:
+            return False
+        record = self.accounts.get(self.account, {}).get(table)
+        return record is not None and record["lastedit"] == self.lastedit(table) \
+            and run_journal.table_checksums(filenames) == record["files"]
+
+    def update(self, table, filenames, df):
+        """
+        Records the table as saved at the current stamp.
+        """
+        if self.account is None or self.lastedit(table) is None:
+            return
+        checksums = run_journal.table_checksums(filenames)
+        if checksums is None:
+            return
+        with self.lock:
+            self.accounts.setdefault(self.account, {})[table] = {"lastedit": self.lastedit(table), "files": checksums}
+            self.save()
+        with parsed_tables_lock:
+            parsed_tables[self.key(table)] = (self.lastedit(table), df, None)
+
+    def get_table(self, table, read):
+        """
+        The table saved at the current stamp: parsed in this process already, or read with read().
+        """
+        with parsed_tables_lock:
+            parsed = parsed_tables.get(self.key(table))
+        if parsed is not None and parsed[0] == self.lastedit(table):
+            return parsed[1]
+        df = read()
+        with parsed_tables_lock:
+            parsed_tables[self.key(table)] = (self.lastedit(table), df, None)
+        return df
+
+    def name_index(self, table, df):
+        """
+        id -> name of the table, built once per stamp of the table.
+        """
+        with parsed_tables_lock:
+            parsed = parsed_tables.get(self.key(table))
+            if parsed is not None and parsed[0] == self.lastedit(table) and parsed[1] is df:
+                if parsed[2] is None:
+                    parsed = (parsed[0], parsed[1], build_name_index(df))
+                    parsed_tables[self.key(table)] = parsed
+                return parsed[2]
+        return build_name_index(df)
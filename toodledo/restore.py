@@ -0,0 +1,421 @@
+"""
+Restores a backup folder into a ToodleDo account: the same one after a loss, or a new one when migrating.
+Folders, contexts, goals and locations go first (the ones the account already has are matched by name),
+then tasks, notes, lists and outlines, with the new ids of their folders, contexts etc.
+Tasks, notes, lists, list rows and outlines are added in batches of ADD_BATCH_SIZE, several batches
+at once. Subtasks get their parents in the second pass, when all the tasks have their new ids.
+
+Every restored item is recorded in the journal (restore_journal.jsonl in the backup folder), so a restore
+that was interrupted continues where it stopped when started again. A batch that failed without
+a response might have been added anyway, restoring it again can make duplicates.
+Lists and outlines are restored on a best-effort basis: the list cells and the outline nodes
+as they were saved, without their ids.
+
+Usage: python restore.py [BACKUP_FOLDER] [--token-file TOKEN_FILE] [--entities ENTITY ...]
+The account is the one the token file is authorized for, restore_token.txt next to this file by default.
+"""
+import os
+import ast
+import json
+import logging
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import yaml
+import pandas as pd
+import auth
+import backup
+import client
+import storage
+
+ADD_URL_POSTFIX = '/add.php'
+EDIT_URL_POSTFIX = '/edit.php'
+# add.php and edit.php take at most 50 items per request
+ADD_BATCH_SIZE = 50
+JOURNAL_FILENAME = 'restore_journal.jsonl'
+RESTORE_TOKEN_FILENAME = backup.CUR_FILE_DIR+"restore_token.txt"
+
+REFERENCE_TABLES = ["folders", "contexts", "goals", "locations"]
+ALL_ENTITIES = REFERENCE_TABLES+["tasks", "notes", "lists", "outlines"]
+# Fields that are set when the item is added. The ids of other items are remapped separately.
+REFERENCE_FIELDS = {
+    "folders": ["name", "private"],
+    "contexts": ["name", "private"],
+    "goals": ["name", "level", "archived", "note"],
+    "locations": ["name", "description", "lat", "lon"],
+}
+TASK_FIELDS = ["title", "tag", "startdate", "duedate", "duedatemod", "starttime", "duetime", "remind",
+        "repeat", "status", "star", "priority", "length", "note", "completed", "meta"]
+# Field -> reference table of its ids
+REFERENCE_ID_FIELDS = {"folder": "folders", "context": "contexts", "goal": "goals", "location": "locations"}
+NOTE_FIELDS = ["title", "text", "private"]
+LIST_FIELDS = ["title", "note", "keywords"]
+LIST_COL_FIELDS = ["title", "type", "sort", "width"]
+OUTLINE_FIELDS = ["title", "hidden", "note", "keywords"]
+
+
+def item_key(value):
+    """
+    Ids as text, the same whether they were read from CSV ("12") or Parquet (12).
+    """
+    if isinstance(value, float):
+        value = int(value)
+    return str(value)
+
+
+def clean_value(field, value):
+    """
+    None for missing values, numbers for the numeric fields.
+    """
+    if value is None or value is pd.NA or (isinstance(value, float) and pd.isna(value)) or value == "":
+        return None
+    try:
+        if field in backup.INTEGER_FIELDS:
+            return int(float(value))
+        if field in backup.FLOAT_FIELDS:
+            return float(value)
+    except ValueError:
+        return None
+    return str(value)
+
+
+def make_item(record, fields):
+    item = {}
+    for field in fields:
+        value = clean_value(field, record.get(field))
+        if value is not None:
+            item[field] = value
+    return item
+
+
+def parse_nested(value):
+    """
+    Nested values (e.g. children of outline nodes) are saved as JSON, or as Python literals by older versions.
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def iter_records(filename):
+    """
+    Records of the saved table, chunk by chunk.
+    """
+    if not storage.table_exists(filename):
+        logging.info("No %s in the backup", os.path.basename(filename))
+        return
+    for chunk in storage.iter_table_chunks(storage.table_filename(filename, storage.backup_formats[0])):
+        for record in chunk.to_dict("records"):
+            yield record
+
+
+def iter_batches(items, batch_size=ADD_BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+class Journal:
+    """
+    Old id -> new id of every restored item, per entity. Appended to the file after every request,
+    so nothing is lost when the restore is interrupted.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.ids = collections.defaultdict(dict)
+        # Items that were referred to, but not restored. Reported once each.
+        self.missing = set()
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            for record in storage.read_records(filename):
+                self.ids[record["entity"]].update(record["ids"])
+            logging.info("Resuming the restore. Already restored: %s",
+                    {i: len(self.ids[i]) for i in self.ids})
+
+    def record(self, entity, ids):
+        if len(ids) == 0:
+            return
+        with self.lock:
+            self.ids[entity].update(ids)
+            with open(self.filename, "at") as f:
+                f.write(json.dumps({"entity": entity, "ids": ids})+"\n")
+
+    def new_id(self, entity, old_id):
+        return self.ids[entity].get(item_key(old_id))
+
+    def remap(self, entity, old_id):
+        """
+        New id of the item for the fields that refer to it. 0 (none) if it was not restored.
+        """
+        old_id = clean_value("id", old_id)
+        if old_id is None or old_id == 0:
+            return 0
+        new_id = self.new_id(entity, old_id)
+        if new_id is None:
+            if (entity, old_id) not in self.missing:
+                self.missing.add((entity, old_id))
+                logging.warning("%s %d was not restored. Leaving it out.", entity, old_id)
+            return 0
+        return new_id
+
+
+def send_batch(access_token, entity, batch, url_postfix=ADD_URL_POSTFIX, url_additions={}):
+    """
+    Sends the batch of (old id, item) to <entity>/add.php or edit.php.
+    Returns old id -> new id of the items that were accepted.
+    """
+    url = backup.API_URL_PREFIX + entity + url_postfix
+    refs_by_id = {}
+    items = []
+    for old_id, item in batch:
+        if url_postfix == ADD_URL_POSTFIX:
+            item = dict(item, ref=old_id)
+        else:
+            refs_by_id[item_key(item["id"])] = old_id
+        items.append(item)
+    data = {'access_token': access_token, entity: json.dumps(items)}
+    for i in url_additions:
+        data[i] = url_additions[i]
+    try:
+        # Adding is not idempotent: a repeated request would add the items twice
+        response = client.post(url, data, idempotent=(url_postfix == EDIT_URL_POSTFIX))
+        if response.status_code != 200:
+            logging.warning("Failed to send %d %s. Response status code: %d.\n Detailed response: %s",
+                    len(items), entity, response.status_code, str(response.text))
+            return {}
+        result_json_parsed = json.loads(response.text)
+        if type(result_json_parsed) != list:
+            logging.warning("Failed to send %d %s. Response body: %s", len(items), entity, result_json_parsed)
+            return {}
+    except Exception as e:
+        logging.warning("Failed to send %d %s: %s", len(items), entity, str(e))
+        return {}
+    ids = {}
+    errors = []
+    for i in result_json_parsed:
+        if "errorCode" in i or "id" not in i:
+            errors.append(i)
+        elif "ref" in i:
+            ids[item_key(i["ref"])] = i["id"]
+        elif item_key(i["id"]) in refs_by_id:
+            ids[refs_by_id[item_key(i["id"])]] = i["id"]
+    if len(errors) > 0:
+        logging.warning("Failed to send %d of %d %s, e.g. %s", len(errors), len(items), entity, errors[0])
+    return ids
+
+
+def send_all(access_token, entity, items, journal, journal_entity=None,
+        url_postfix=ADD_URL_POSTFIX, url_additions={}):
+    """
+    Sends (old id, item) pairs in batches, several batches at once, and records the results
+    in the journal as they come. Returns the number of items that were accepted.
+    """
+    sent = 0
+    with ThreadPoolExecutor(max_workers=client.max_concurrent_requests) as executor:
+        for ids in backup.map_bounded(executor,
+                lambda batch: send_batch(access_token, entity, batch, url_postfix, url_additions),
+                iter_batches(items), 2*client.max_concurrent_requests):
+            journal.record(journal_entity or entity, ids)
+            sent += len(ids)
+            logging.info("Sent %d %s", sent, journal_entity or entity)
+    return sent
+
+
+def restore_reference_table(access_token, backup_path, entity, journal):
+    """
+    One item per request, as the API takes them. Goals are added from the top level down,
+    so that the goals they contribute to are there already.
+    """
+    records = list(iter_records(backup_path+entity+".csv"))
+    if entity == "goals":
+        records.sort(key=lambda i: clean_value("level", i.get("level")) or 0)
+    existing_df = backup.generic_get_and_backup(access_token=access_token, parameter_name=entity,
+            default_fields=["id", "name"])
+    existing = dict(zip(existing_df["name"], existing_df["id"])) if len(existing_df) > 0 else {}
+    url = backup.API_URL_PREFIX + entity + ADD_URL_POSTFIX
+    added = 0
+    for record in records:
+        old_id = item_key(record["id"])
+        if journal.new_id(entity, old_id) is not None:
+            continue
+        if record.get("name") in existing:
+            journal.record(entity, {old_id: existing[record["name"]]})
+            continue
+        data = make_item(record, REFERENCE_FIELDS[entity])
+        if entity == "goals":
+            data["contributes"] = journal.remap("goals", record.get("contributes"))
+        data["access_token"] = access_token
+        try:
+            response = client.post(url, data, idempotent=False)
+            result_json_parsed = json.loads(response.text)
+            if response.status_code == 200 and type(result_json_parsed) == list and len(result_json_parsed) > 0 \
+                    and "id" in result_json_parsed[0]:
+                journal.record(entity, {old_id: result_json_parsed[0]["id"]})
+                added += 1
+            else:
+                logging.warning("Failed to add %s %s. Response status code: %d.\n Detailed response: %s",
+                        entity, record.get("name"), response.status_code, str(response.text))
+        except Exception as e:
+            logging.warning("Failed to add %s %s: %s", entity, record.get("name"), str(e))
+    logging.info("Restored %s: %d added, %d in total", entity, added, len(journal.ids[entity]))
+
+
+def iter_task_items(backup_path, journal):
+    for record in iter_records(backup_path+"raw_tasks.csv"):
+        old_id = item_key(record["id"])
+        if journal.new_id("tasks", old_id) is None:
+            item = make_item(record, TASK_FIELDS)
+            item.setdefault("title", "")
+            for field in REFERENCE_ID_FIELDS:
+                item[field] = journal.remap(REFERENCE_ID_FIELDS[field], record.get(field))
+            yield old_id, item
+
+
+def iter_parent_edits(backup_path, journal):
+    for record in iter_records(backup_path+"raw_tasks.csv"):
+        old_id = item_key(record["id"])
+        parent = clean_value("parent", record.get("parent"))
+        if parent and journal.new_id("parents", old_id) is None and journal.new_id("tasks", old_id) is not None:
+            new_parent = journal.remap("tasks", parent)
+            if new_parent:
+                yield old_id, {"id": journal.new_id("tasks", old_id), "parent": new_parent}
+
+
+def restore_tasks(access_token, backup_path, journal):
+    added = send_all(access_token, "tasks", iter_task_items(backup_path, journal), journal)
+    # Subtasks: all the tasks have their new ids only now
+    edited = send_all(access_token, "tasks", iter_parent_edits(backup_path, journal), journal,
+            journal_entity="parents", url_postfix=EDIT_URL_POSTFIX)
+    logging.info("Restored tasks: %d added, %d subtasks linked to their parents", added, edited)
+
+
+def restore_notes(access_token, backup_path, journal):
+    def iter_note_items():
+        for record in iter_records(backup_path+"notes.csv"):
+            old_id = item_key(record["id"])
+            if journal.new_id("notes", old_id) is None:
+                item = make_item(record, NOTE_FIELDS)
+                item.setdefault("title", "")
+                item["folder"] = journal.remap("folders", record.get("folder"))
+                yield old_id, item
+    added = send_all(access_token, "notes", iter_note_items(), journal)
+    logging.info("Restored notes: %d added", added)
+
+
+def group_records(filename, key_field):
+    result = collections.defaultdict(list)
+    for record in iter_records(filename):
+        result[item_key(record[key_field])].append(record)
+    return result
+
+
+def restore_lists(access_token, backup_path, journal):
+    """
+    Lists are added with their columns, then their rows. Cell N of a row goes to the N-th column,
+    as in the backup.
+    """
+    cols = group_records(backup_path+"lists_cols.csv", "list_id")
+
+    def iter_list_items():
+        for record in iter_records(backup_path+"lists.csv"):
+            old_id = item_key(record["id"])
+            if journal.new_id("lists", old_id) is None:
+                item = make_item(record, LIST_FIELDS)
+                item.setdefault("title", "")
+                item["cols"] = [make_item(i, LIST_COL_FIELDS) for i in cols.get(old_id, [])]
+                yield old_id, item
+    added = send_all(access_token, "lists", iter_list_items(), journal)
+
+    cells = collections.defaultdict(dict)
+    for record in iter_records(backup_path+"lists_cells.csv"):
+        list_cols = [item_key(i["id"]) for i in cols.get(item_key(record["list_id"]), [])]
+        column = item_key(record["column_ids"])
+        value = record.get("value")
+        if column in list_cols and clean_value("value", value) is not None:
+            cells[item_key(record["row_id"])]["c"+str(list_cols.index(column)+1)] = value
+    rows = group_records(backup_path+"lists_rows.csv", "list_id")
+    added_rows = 0
+    for list_id in rows:
+        new_list_id = journal.new_id("lists", list_id)
+        if new_list_id is None:
+            continue
+        row_items = [(item_key(i["id"]), {"cells": cells.get(item_key(i["id"]), {})}) for i in rows[list_id]
+                     if journal.new_id("rows", i["id"]) is None]
+        added_rows += send_all(access_token, "rows", row_items, journal, url_additions={"list": new_list_id})
+    logging.info("Restored lists: %d added with %d rows", added, added_rows)
+
+
+def make_outline_node(record):
+    node = {}
+    for field in record:
+        if field in ("id", "outline_id"):
+            continue
+        value = parse_nested(record[field])
+        if isinstance(value, (list, dict)) or clean_value(field, value) is not None:
+            node[field] = value
+    return node
+
+
+def restore_outlines(access_token, backup_path, journal):
+    nodes = group_records(backup_path+"outlines_rows.csv", "outline_id")
+
+    def iter_outline_items():
+        for record in iter_records(backup_path+"outlines.csv"):
+            old_id = item_key(record["id"])
+            if journal.new_id("outlines", old_id) is None:
+                item = make_item(record, OUTLINE_FIELDS)
+                item.setdefault("title", "")
+                item["outline"] = {"children": [make_outline_node(i) for i in nodes.get(old_id, [])]}
+                yield old_id, item
+    added = send_all(access_token, "outlines", iter_outline_items(), journal)
+    logging.info("Restored outlines: %d added", added)
+
+
+def restore(access_token, backup_path, entities=ALL_ENTITIES, journal_filename=None):
+    """
+    Restores the entities from the backup folder. The reference tables go first, the rest at once.
+    """
+    journal = Journal(journal_filename or backup_path+JOURNAL_FILENAME)
+    backup.run_concurrently({i: (lambda i=i: restore_reference_table(access_token, backup_path, i, journal))
+                             for i in REFERENCE_TABLES if i in entities})
+    restorers = {"tasks": restore_tasks, "notes": restore_notes, "lists": restore_lists,
+                 "outlines": restore_outlines}
+    backup.run_concurrently({i: (lambda i=i: restorers[i](access_token, backup_path, journal))
+                             for i in restorers if i in entities})
+    logging.info("Restore finished. Restored: %s", {i: len(journal.ids[i]) for i in journal.ids})
+    return journal
+
+
+if __name__=="__main__":
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Restore a ToodleDo backup into an account")
+    parser.add_argument("backup_folder", nargs="?", help="BACKUP_FOLDER of the config by default")
+    parser.add_argument("--token-file", default=RESTORE_TOKEN_FILENAME,
+            help="Tokens of the account to restore to. Authorized from scratch if missing.")
+    parser.add_argument("--entities", nargs="+", choices=ALL_ENTITIES, default=ALL_ENTITIES)
+    parser.add_argument("--journal", help="Journal of the restore, restore_journal.jsonl in the backup folder by default")
+    args = parser.parse_args()
+
+    with open(backup.CONFIG_FILENAME, "rt") as f:
+        config = yaml.load(f, Loader=yaml.CLoader)
+    backup_path = os.path.normpath(args.backup_folder)+os.path.sep if args.backup_folder \
+        else backup.get_backup_path(config)
+    logging.info("Restoring from %s", backup_path)
+    access_token, refresh_token = auth.get_tokens(config, args.token_file, auth.WRITE_SCOPES)
+    auth.save_tokens(access_token, refresh_token, args.token_file)
+    storage.set_backup_formats(config.get(backup.BACKUP_FORMATS_FIELD, [storage.CSV_FORMAT]))
+    backup.configure_client(config, refresh_token, args.token_file)
+    restore(access_token, backup_path, args.entities, args.journal)
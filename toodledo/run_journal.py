@@ -0,0 +1,122 @@
+"""
+Journal of the backup run, kept in the backup folder: the finished stages and the finished lists and
+outlines, each with the checksums of the files it wrote. If the run is interrupted, the next one resumes
+it: the work whose files are still intact is skipped instead of being fetched again.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import storage
+
+RUN_JOURNAL_FILENAME = 'run_journal.jsonl'
+# An older interrupted run is not resumed: what it fetched is likely outdated
+MAX_RESUME_AGE_SECONDS = 24*3600
+CHECKSUM_CHUNK_SIZE = 1024*1024
+
+
+def file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def table_checksums(filenames):
+    """
+    Path -> checksum of every format of the tables. None if a table is missing.
+    """
+    result = {}
+    for filename in filenames:
+        for table_format in storage.backup_formats:
+            path = storage.table_filename(filename, table_format)
+            if not os.path.isfile(path):
+                return None
+            result[path] = file_checksum(path)
+    return result
+
+
+def files_intact(checksums):
+    try:
+        return all(file_checksum(path) == checksums[path] for path in checksums)
+    except OSError:
+        return False
+
+
+class RunJournal:
+    """
+    The journal is appended to as the work is done, one JSON record per line: the start of the run,
+    finished stages, finished items (lists, outlines) and the end of the run.
+    """
+    def __init__(self, backup_path, resume=True, max_age=MAX_RESUME_AGE_SECONDS):
+        self.filename = backup_path+RUN_JOURNAL_FILENAME
+        self.lock = threading.Lock()
+        # Work finished by the interrupted run
+        self.stages = {}
+        self.items = {}
+        previous = self.load() if resume else []
+        if len(previous) > 0 and "started" in previous[0] and not any(i.get("finished_run") for i in previous) \
+                and time.time()-previous[0]["started"] < max_age:
+            for record in previous:
+                if "stage" in record:
+                    self.stages[record["stage"]] = record["files"]
+                elif "item" in record:
+                    self.items[(record["item"], str(record["id"]))] = record
+            logging.info("Resuming the run interrupted at %s. Finished stages: %s, items: %d",
+                    time.ctime(previous[-1].get("time", previous[0]["started"])),
+                    sorted(self.stages), len(self.items))
+            self.started = previous[0]["started"]
+            self.file = open(self.filename, "at")
+        else:
+            self.started = time.time()
+            self.file = open(self.filename, "wt")
+            self.append({"started": self.started})
+
+    def load(self):
+        return storage.read_records(self.filename)
+
+    def append(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record)+"\n")
+            # The record must survive the process being killed right after
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def stage_done(self, name):
+        """
+        True if the interrupted run finished the stage and its files are intact.
+        """
+        if name not in self.stages:
+            return False
+        if not files_intact(self.stages[name]):
+            logging.info("Files of stage %s changed since it was finished. Running it again.", name)
+            return False
+        return True
+
+    def finish_stage(self, name, filenames=()):
+        checksums = table_checksums(filenames)
+        if checksums is None:
+            logging.warning("Stage %s did not write all of its tables. Not recording it as finished.", name)
+            return
+        self.append({"stage": name, "files": checksums, "time": time.time()})
+
+    def item_done(self, kind, item_id, modified):
+        """
+        True if the interrupted run finished the item (e.g. a list), it has not been modified since
+        and its files are intact.
+        """
+        record = self.items.get((kind, str(item_id)))
+        return record is not None and str(record["modified"]) == str(modified) and files_intact(record["files"])
+
+    def finish_item(self, kind, item_id, modified, filenames):
+        checksums = table_checksums(filenames)
+        if checksums is not None:
+            self.append({"item": kind, "id": item_id, "modified": modified, "files": checksums,
+                         "time": time.time()})
+
+    def finish(self):
+        self.append({"finished_run": True, "time": time.time()})
+        self.file.close()
@@ -0,0 +1,195 @@
+"""
+History of the backups as a content-addressed store under <backup folder>/Snapshots.
+Every record (task, note, list row, outline node...) is saved once under the hash of its content,
+and every snapshot is a small manifest of record keys and hashes. Unchanged records cost nothing,
+so the store grows with the changes, not with the number of runs.
+
+Usage:
+    python snapshots.py BACKUP_FOLDER list
+    python snapshots.py BACKUP_FOLDER take
+    python snapshots.py BACKUP_FOLDER restore SNAPSHOT OUTPUT_FOLDER
+    python snapshots.py BACKUP_FOLDER diff OLD_SNAPSHOT NEW_SNAPSHOT
+"""
+import os
+import sys
+import gzip
+import json
+import hashlib
+import logging
+import argparse
+import datetime
+import pandas as pd
+import storage
+
+SNAPSHOTS_FOLDER = "Snapshots"
+OBJECTS_FOLDER = "objects"
+MANIFESTS_FOLDER = "manifests"
+MANIFEST_POSTFIX = ".json.gz"
+RESTORE_CHUNK_SIZE = 10000
+
+# Entity -> (table in the backup folder, columns that identify the record)
+SNAPSHOT_TABLES = {
+    "tasks": ("raw_tasks.csv", ["id"]),
+    "notes": ("notes.csv", ["id"]),
+    "folders": ("folders.csv", ["id"]),
+    "contexts": ("contexts.csv", ["id"]),
+    "goals": ("goals.csv", ["id"]),
+    "locations": ("locations.csv", ["id"]),
+    "lists": ("lists.csv", ["id"]),
+    "list_rows": ("lists_rows.csv", ["list_id", "id"]),
+    "list_cols": ("lists_cols.csv", ["list_id", "id"]),
+    "outlines": ("outlines.csv", ["id"]),
+    "outline_rows": ("outlines_rows.csv", ["outline_id", "id"]),
+}
+
+
+def get_store_path(backup_path):
+    return backup_path+SNAPSHOTS_FOLDER+os.path.sep
+
+
+def object_filename(store_path, record_hash):
+    return os.path.join(store_path, OBJECTS_FOLDER, record_hash[:2], record_hash[2:]+".json")
+
+
+def manifest_filename(store_path, snapshot_id):
+    return os.path.join(store_path, MANIFESTS_FOLDER, snapshot_id+MANIFEST_POSTFIX)
+
+
+def list_snapshots(store_path):
+    manifests_path = os.path.join(store_path, MANIFESTS_FOLDER)
+    if not os.path.isdir(manifests_path):
+        return []
+    return sorted(i[:-len(MANIFEST_POSTFIX)] for i in os.listdir(manifests_path) if i.endswith(MANIFEST_POSTFIX))
+
+
+def load_manifest(store_path, snapshot_id):
+    with gzip.open(manifest_filename(store_path, snapshot_id), "rt") as f:
+        return json.load(f)
+
+
+def save_object(record_filename, encoded):
+    storage.write_atomically(record_filename, encoded)
+
+
+def encode_record(record):
+    """
+    Canonical text of the record: every value as text, missing values as empty strings,
+    sorted keys. The same record gives the same hash whichever format it was read from.
+    """
+    record = {k: ("" if pd.isna(v) else str(v)) for k, v in record.items()}
+    return json.dumps(record, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def store_table(store_path, filename, key_columns, known_hashes):
+    """
+    Saves the records of the table that are not in the store yet.
+    Returns the table manifest: columns and [key, hash] per record.
+    """
+    path = storage.table_filename(filename, storage.backup_formats[0])
+    columns = storage.table_columns(path)
+    records = []
+    for chunk in storage.iter_table_chunks(path):
+        for record in chunk.to_dict("records"):
+            encoded = encode_record(record)
+            record_hash = hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+            if record_hash not in known_hashes:
+                record_filename = object_filename(store_path, record_hash)
+                if not os.path.isfile(record_filename):
+                    save_object(record_filename, encoded)
+                known_hashes.add(record_hash)
+            key = "/".join("" if pd.isna(record[i]) else str(record[i]) for i in key_columns)
+            records.append([key, record_hash])
+    return {"columns": columns, "records": records}
+
+
+def take_snapshot(backup_path, snapshot_id=None):
+    """
+    Adds the current state of the backup folder to the store. Returns the snapshot id.
+    """
+    store_path = get_store_path(backup_path)
+    snapshot_id = snapshot_id or datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    # Records of the previous snapshot are in the store for sure, no need to check the disk for them
+    known_hashes = set()
+    previous_snapshots = list_snapshots(store_path)
+    if len(previous_snapshots) > 0:
+        for table in load_manifest(store_path, previous_snapshots[-1])["tables"].values():
+            known_hashes.update(i[1] for i in table["records"])
+    stored_before = len(known_hashes)
+    manifest = {"id": snapshot_id, "tables": {},
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    for entity in SNAPSHOT_TABLES:
+        filename, key_columns = SNAPSHOT_TABLES[entity]
+        if not storage.table_exists(backup_path+filename):
+            logging.info("No %s in the backup. Not adding them to the snapshot.", entity)
+            continue
+        manifest["tables"][entity] = store_table(store_path, backup_path+filename, key_columns, known_hashes)
+
+    storage.write_atomically(manifest_filename(store_path, snapshot_id), json.dumps(manifest, separators=(",", ":")),
+            gzip.open)
+    logging.info("Saved snapshot %s. Records: %d, new: %d", snapshot_id,
+            sum(len(i["records"]) for i in manifest["tables"].values()), len(known_hashes)-stored_before)
+    return snapshot_id
+
+
+def restore_snapshot(store_path, snapshot_id, output_path):
+    """
+    Writes the tables of the snapshot to output_path as CSVs with the same names as in the backup folder.
+    """
+    manifest = load_manifest(store_path, snapshot_id)
+    os.makedirs(output_path, exist_ok=True)
+    for entity in manifest["tables"]:
+        table = manifest["tables"][entity]
+        filename = os.path.join(output_path, SNAPSHOT_TABLES[entity][0])
+        with storage.TableWriter(filename, table["columns"], formats=[storage.CSV_FORMAT]) as writer:
+            for start in range(0, len(table["records"]), RESTORE_CHUNK_SIZE):
+                records = []
+                for key, record_hash in table["records"][start:start+RESTORE_CHUNK_SIZE]:
+                    with open(object_filename(store_path, record_hash), "rt", encoding="utf-8") as f:
+                        records.append(json.load(f))
+                writer.write(pd.DataFrame(records, columns=table["columns"]))
+        logging.info("Restored %d %s", len(table["records"]), entity)
+
+
+def diff_snapshots(store_path, old_snapshot_id, new_snapshot_id):
+    """
+    Entity -> {"added": keys, "removed": keys, "changed": keys}. Only the manifests are read.
+    """
+    old_tables = load_manifest(store_path, old_snapshot_id)["tables"]
+    new_tables = load_manifest(store_path, new_snapshot_id)["tables"]
+    result = {}
+    for entity in SNAPSHOT_TABLES:
+        old_records = dict(map(tuple, old_tables.get(entity, {}).get("records", [])))
+        new_records = dict(map(tuple, new_tables.get(entity, {}).get("records", [])))
+        result[entity] = {
+            "added": [i for i in new_records if i not in old_records],
+            "removed": [i for i in old_records if i not in new_records],
+            "changed": [i for i in new_records if i in old_records and new_records[i] != old_records[i]],
+        }
+    return result
+
+
+if __name__=="__main__":
+    logging.basicConfig(format='%(asctime)s-%(levelname)s-%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Snapshots of the ToodleDo backups")
+    parser.add_argument("backup_folder")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list")
+    commands.add_parser("take")
+    restore_parser = commands.add_parser("restore")
+    restore_parser.add_argument("snapshot")
+    restore_parser.add_argument("output_folder")
+    diff_parser = commands.add_parser("diff")
+    diff_parser.add_argument("old_snapshot")
+    diff_parser.add_argument("new_snapshot")
+    args = parser.parse_args()
+
+    backup_path = os.path.normpath(args.backup_folder)+os.path.sep
+    if args.command == "list":
+        print("\n".join(list_snapshots(get_store_path(backup_path))))
+    elif args.command == "take":
+        print(take_snapshot(backup_path))
+    elif args.command == "restore":
+        restore_snapshot(get_store_path(backup_path), args.snapshot, args.output_folder)
+    elif args.command == "diff":
+        json.dump(diff_snapshots(get_store_path(backup_path), args.old_snapshot, args.new_snapshot),
+                sys.stdout, indent=2)
@@ -0,0 +1,338 @@
+"""
+Backup tables on disk. Every table is addressed by its ".csv" filename and written in each of the
+configured formats: CSV (text, as before) and/or Parquet (compressed, columnar, typed by the schema).
+Parquet needs pyarrow, which is optional.
+"""
+import os
+import json
+import time
+import logging
+import pandas as pd
+import metrics
+
+CSV_FORMAT = "csv"
+PARQUET_FORMAT = "parquet"
+ALL_FORMATS = [CSV_FORMAT, PARQUET_FORMAT]
+PARQUET_COMPRESSION = "zstd"
+
+# Schema types: table schemas map column names to these. Columns without a type are text.
+TEXT_TYPE = "string"
+INTEGER_TYPE = "Int64"
+FLOAT_TYPE = "float64"
+
+DELTA_POSTFIX = '.delta'
+TEMP_POSTFIX = '.tmp'
+MERGE_CHUNK_SIZE = 100000
+# Small chunks are buffered up to this many rows before they are written
+WRITE_BUFFER_ROWS = 10000
+
+backup_formats = [CSV_FORMAT]
+
+
+def write_atomically(filename, text, opener=open):
+    """
+    Writes the text to a temporary file first and moves it in place, so that a reader (or the next run)
+    never finds the file half-written. opener is e.g. gzip.open for a compressed file.
+    """
+    if os.path.dirname(filename) != "":
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp_filename = filename+TEMP_POSTFIX
+    with opener(temp_filename, "wt", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_filename, filename)
+
+
+def read_records(filename):
+    """
+    Records of a journal file, one JSON object per line. The file is appended to as the work goes,
+    and its last line is cut if the process was killed while writing it: that line is skipped.
+    """
+    if not os.path.isfile(filename):
+        return []
+    records = []
+    with open(filename, "rt") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def set_backup_formats(formats):
+    """
+    The first format is the one the tables are read back from.
+    """
+    global backup_formats
+    formats = [i for i in formats if i in ALL_FORMATS]
+    if PARQUET_FORMAT in formats:
+        try:
+            import pyarrow
+        except ImportError:
+            logging.warning("pyarrow is not installed. Parquet backups are disabled.")
+            formats.remove(PARQUET_FORMAT)
+    backup_formats = formats if len(formats) > 0 else [CSV_FORMAT]
+    logging.info("Backup formats: %s", backup_formats)
+
+
+def table_filename(filename, table_format):
+    root, ext = os.path.splitext(filename)
+    return root+"."+table_format
+
+
+def delta_filename(filename):
+    root, ext = os.path.splitext(filename)
+    return root+DELTA_POSTFIX+ext
+
+
+def table_exists(filename):
+    return os.path.isfile(table_filename(filename, backup_formats[0]))
+
+
+def remove_table(filename):
+    for table_format in ALL_FORMATS:
+        if os.path.isfile(table_filename(filename, table_format)):
+            os.remove(table_filename(filename, table_format))
+            logging.info("Removed %s", table_filename(filename, table_format))
+
+
+def make_schema(fields, integer_fields=(), float_fields=()):
+    schema = {}
+    for i in fields:
+        if i in integer_fields:
+            schema[i] = INTEGER_TYPE
+        elif i in float_fields:
+            schema[i] = FLOAT_TYPE
+        else:
+            schema[i] = TEXT_TYPE
+    return schema
+
+
+def to_text(value):
+    if type(value) in (dict, list):
+        return json.dumps(value)
+    return str(value)
+
+
+def apply_schema(df, schema):
+    """
+    Casts the columns to their schema types, nested values (lists, dicts) become JSON text.
+    Values that do not fit the type are dropped with a warning: every chunk of a table
+    must get exactly the same types.
+    """
+    result = pd.DataFrame(index=df.index)
+    for column in df.columns:
+        column_type = schema.get(column, TEXT_TYPE) if schema is not None else TEXT_TYPE
+        values = df[column]
+        if column_type == TEXT_TYPE:
+            result[column] = values.map(to_text, na_action="ignore").astype(TEXT_TYPE)
+            continue
+        converted = pd.to_numeric(values, errors="coerce")
+        if column_type == INTEGER_TYPE:
+            converted = converted.where(converted % 1 == 0)
+        lost = converted.isna() & values.notna() & (values.astype(str) != "")
+        if lost.any():
+            logging.warning("Column %s: %d values are not %s, e.g. %s. Dropping them.",
+                    column, lost.sum(), column_type, values[lost].iloc[0])
+        result[column] = converted.astype(column_type)
+    return result
+
+
+class CsvSink:
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.file = open(path, "wt", newline="")
+        pd.DataFrame(columns=columns).to_csv(self.file, index=False)
+
+    def write(self, df):
+        df.reindex(columns=self.columns).to_csv(self.file, header=False, index=False)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    def __init__(self, path, columns, schema):
+        import pyarrow
+        import pyarrow.parquet
+        arrow_types = {TEXT_TYPE: pyarrow.string(), INTEGER_TYPE: pyarrow.int64(), FLOAT_TYPE: pyarrow.float64()}
+        self.pyarrow = pyarrow
+        self.columns = columns
+        self.schema = {i: (schema or {}).get(i, TEXT_TYPE) for i in columns}
+        self.arrow_schema = pyarrow.schema([(i, arrow_types[self.schema[i]]) for i in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.arrow_schema, compression=PARQUET_COMPRESSION)
+
+    def write(self, df):
+        df = apply_schema(df.reindex(columns=self.columns), self.schema)
+        self.writer.write_table(
+            self.pyarrow.Table.from_pandas(df, schema=self.arrow_schema, preserve_index=False))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_sink(path, table_format, columns, schema=None):
+    if table_format == PARQUET_FORMAT:
+        return ParquetSink(path, columns, schema)
+    return CsvSink(path, columns)
+
+
+class TableWriter:
+    """
+    Writes a table chunk by chunk to all the configured formats. The chunks go to temporary files
+    that replace the table only on close(), so an interrupted or aborted write leaves
+    the previous version of the table intact instead of a truncated one.
+    Small chunks are buffered and written together, at most WRITE_BUFFER_ROWS rows at once.
+    """
+    def __init__(self, filename, columns, schema=None, formats=None):
+        self.paths = [table_filename(filename, i) for i in (formats or backup_formats)]
+        self.sinks = []
+        self.buffer = []
+        self.buffered_rows = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.finished = False
+        try:
+            for path, table_format in zip(self.paths, formats or backup_formats):
+                self.sinks.append(open_sink(path+TEMP_POSTFIX, table_format, list(columns), schema))
+        except Exception:
+            self.abort()
+            raise
+
+    def write(self, df):
+        if len(df) == 0:
+            return
+        self.buffer.append(df)
+        self.buffered_rows += len(df)
+        if self.buffered_rows >= WRITE_BUFFER_ROWS:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        df = self.buffer[0] if len(self.buffer) == 1 else pd.concat(self.buffer, ignore_index=True)
+        self.buffer = []
+        self.buffered_rows = 0
+        start = time.perf_counter()
+        for sink in self.sinks:
+            sink.write(df)
+        self.rows += len(df)
+        self.seconds += time.perf_counter()-start
+
+    def close(self):
+        if self.finished:
+            return
+        self.flush()
+        self.finished = True
+        start = time.perf_counter()
+        for sink in self.sinks:
+            sink.close()
+        for path in self.paths:
+            os.replace(path+TEMP_POSTFIX, path)
+        metrics.observe_table(self.paths[0], self.rows, self.seconds+time.perf_counter()-start)
+
+    def abort(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.buffer = []
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                logging.warning("Failed to close %s: %s", sink, str(e))
+        for path in self.paths:
+            if os.path.isfile(path+TEMP_POSTFIX):
+                os.remove(path+TEMP_POSTFIX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def iter_table_chunks(path, chunksize=MERGE_CHUNK_SIZE):
+    """
+    CSV chunks are read as text, so that writing them back does not change them.
+    """
+    if path.endswith("."+PARQUET_FORMAT):
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunksize):
+            yield chunk
+
+
+def table_columns(path):
+    if path.endswith("."+PARQUET_FORMAT):
+        import pyarrow.parquet
+        return list(pyarrow.parquet.read_schema(path).names)
+    return list(pd.read_csv(path, dtype=str, nrows=0).columns)
+
+
+def read_table(filename, columns=None, schema=None):
+    """
+    Reads the table from the first configured format. Parquet columns get their schema types back.
+    """
+    table_format = backup_formats[0]
+    path = table_filename(filename, table_format)
+    if table_format == PARQUET_FORMAT:
+        df = pd.read_parquet(path, columns=columns)
+        return apply_schema(df, schema) if schema is not None else df
+    return pd.read_csv(path, usecols=columns)
+
+
+def copy_table(source_path, filename, table_format, schema=None):
+    with TableWriter(filename, table_columns(source_path), schema, formats=[table_format]) as writer:
+        for chunk in iter_table_chunks(source_path):
+            writer.write(chunk)
+
+
+def merge_delta_table(filename, delta, key, removed_keys=(), schema=None):
+    """
+    Replaces the rows of the table whose key is either in the delta table or in removed_keys
+    with the rows of the delta table, in every configured format. Both tables are streamed in chunks.
+    """
+    for table_format in backup_formats:
+        path = table_filename(filename, table_format)
+        delta_path = table_filename(delta, table_format)
+        if not os.path.isfile(path):
+            # The format was enabled after the table had been saved
+            copy_table(table_filename(filename, backup_formats[0]), filename, table_format, schema)
+        replaced_keys = set(str(i) for i in removed_keys)
+        for chunk in iter_table_chunks(delta_path):
+            replaced_keys.update(chunk[key].astype(str))
+        columns = table_columns(path)
+        columns += [i for i in table_columns(delta_path) if i not in columns]
+        with TableWriter(filename, columns, schema, formats=[table_format]) as writer:
+            for chunk in iter_table_chunks(path):
+                writer.write(chunk[~chunk[key].astype(str).isin(replaced_keys)])
+            for chunk in iter_table_chunks(delta_path):
+                writer.write(chunk)
+        os.remove(delta_path)
+
+
+def save_table(df, filename, readable_table_name, merge_on=None, removed_keys=(), schema=None):
+    """
+    Saves df in all the configured formats. If merge_on is set and the table already exists,
+    df is treated as a delta: the rows with the same merge_on values (or values listed
+    in removed_keys) are replaced.
+    """
+    try:
+        if merge_on is None or not table_exists(filename):
+            with TableWriter(filename, df.columns, schema) as writer:
+                writer.write(df)
+        else:
+            with TableWriter(delta_filename(filename), df.columns, schema) as writer:
+                writer.write(df)
+            merge_delta_table(filename, delta_filename(filename), merge_on, removed_keys, schema)
+        logging.info("Saved %s successfully", readable_table_name)
+        return True
+    except Exception as e:
+        logging.warning("Failed to backup %s: %s", readable_table_name, str(e))
+        return False
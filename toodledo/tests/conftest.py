@@ -0,0 +1,38 @@
+import os
+import sys
+import pytest
+
+# The modules are scripts that import each other as siblings
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import mock_server
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    """
+    Mock API server of a small account, with the backup pointed at it. Tests change the account
+    and server.failing_endpoints between the runs.
+    """
+    import auth
+    import backup
+    server = mock_server.MockApiServer(mock_server.SyntheticAccount.scaled(2000)).start()
+    monkeypatch.setattr(backup, "API_URL_PREFIX", server.url)
+    monkeypatch.setattr(auth, "refresh_tokens", lambda config, access_token, refresh_token:
+                        (access_token, refresh_token))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backup_config(tmp_path):
+    """
+    Config of a backup into tmp_path/backup, without retries and with the saved tokens.
+    """
+    token_filename = str(tmp_path/"token.txt")
+    with open(token_filename, "wt") as f:
+        f.write("access\nrefresh")
+    return {"CLIENT_ID": "id", "CLIENT_SECRET": "secret", "REDIRECT_URL": "http://localhost/",
+            "BACKUP_FOLDER": str(tmp_path/"backup")+os.path.sep, "MAX_RETRIES": 0,
+            "TOKEN_FILE": token_filename}
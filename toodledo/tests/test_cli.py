@@ -0,0 +1,14 @@
+import os
+import sys
+import subprocess
+import pytest
+
+CLI_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cli.py")
+
+
+@pytest.mark.parametrize("command, usage", [("restore", "restore.py"), ("benchmark", "benchmark.py"),
+                                            ("diff", "diff_backups.py")])
+def test_module_options_are_passed_through(command, usage):
+    result = subprocess.run([sys.executable, CLI_FILENAME, command, "--help"], capture_output=True, text=True)
+    assert result.returncode == 0
+    assert result.stdout.startswith("usage: "+usage)
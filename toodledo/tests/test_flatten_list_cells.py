@@ -0,0 +1,42 @@
+from backup import flatten_list_cells
+
+COLS = [{"id": 10, "title": "Name"}, {"id": 20, "title": "Count"}, {"id": 30, "title": "Done"}]
+
+
+def records(df):
+    return list(zip(df["row_id"], df["column_ids"], df["value"]))
+
+
+def test_one_record_per_row_and_column():
+    rows = [{"id": 1, "cells": {"c1": "a", "c2": "1", "c3": "yes"}},
+            {"id": 2, "cells": {"c1": "b", "c2": "2", "c3": "no"}}]
+    df = flatten_list_cells(rows, COLS)
+    assert list(df.columns) == ["value", "row_id", "column_ids"]
+    assert records(df) == [(1, 10, "a"), (1, 20, "1"), (1, 30, "yes"),
+                           (2, 10, "b"), (2, 20, "2"), (2, 30, "no")]
+
+
+def test_fewer_cells_than_columns():
+    rows = [{"id": 1, "cells": {"c1": "a"}}, {"id": 2, "cells": {"c3": "no"}}]
+    assert records(flatten_list_cells(rows, COLS)) == [(1, 10, "a"), (1, 20, None), (1, 30, None),
+                                                       (2, 10, None), (2, 20, None), (2, 30, "no")]
+
+
+def test_more_cells_than_columns(caplog):
+    rows = [{"id": 1, "cells": {"c1": "a", "c2": "1", "c3": "yes", "c4": "extra"}}]
+    df = flatten_list_cells(rows, COLS, list_id=5)
+    assert records(df) == [(1, 10, "a"), (1, 20, "1"), (1, 30, "yes")]
+    assert "c4" in caplog.text and "5" in caplog.text
+
+
+def test_empty_cells():
+    # The API sends [] instead of {} for a row without cells
+    rows = [{"id": 1, "cells": []}, {"id": 2, "cells": {"c2": "2"}}, {"id": 3}]
+    assert records(flatten_list_cells(rows, COLS)) == [(1, 10, None), (1, 20, None), (1, 30, None),
+                                                       (2, 10, None), (2, 20, "2"), (2, 30, None),
+                                                       (3, 10, None), (3, 20, None), (3, 30, None)]
+
+
+def test_all_cells_empty():
+    df = flatten_list_cells([{"id": 1, "cells": []}, {"id": 2, "cells": []}], COLS[:2])
+    assert records(df) == [(1, 10, None), (1, 20, None), (2, 10, None), (2, 20, None)]
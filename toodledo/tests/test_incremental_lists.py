@@ -0,0 +1,38 @@
+import json
+import backup
+import storage
+
+
+def run_lists(config):
+    return backup.run_backup(config, config["TOKEN_FILE"], interactive=False, entities=["lists"])
+
+
+def list_rows(config, list_id):
+    rows = storage.read_table(config["BACKUP_FOLDER"]+"lists_rows.csv")
+    return rows[rows["list_id"] == list_id]
+
+
+def test_failed_rows_keep_the_previous_backup(mock_api, backup_config):
+    backup_config["INCREMENTAL"] = True
+    run_lists(backup_config)
+    with open(backup_config["BACKUP_FOLDER"]+backup.SYNC_STATE_FILENAME) as f:
+        stamp = json.load(f)["lists"]
+    assert len(list_rows(backup_config, 2)) == 20
+
+    # List 2 changes, along with the new ones, but none of their rows can be fetched
+    mock_api.account.lists += 3
+    mock_api.failing_endpoints.add("rows/get.php")
+    report = run_lists(backup_config)
+    assert "lists" in report["failed_stages"]
+    assert len(list_rows(backup_config, 2)) == 20
+    assert len(storage.read_table(backup_config["BACKUP_FOLDER"]+"Lists/rows_list_2.csv")) == 20
+    with open(backup_config["BACKUP_FOLDER"]+backup.SYNC_STATE_FILENAME) as f:
+        assert json.load(f)["lists"] == stamp
+
+    # The next run fetches them again
+    mock_api.failing_endpoints.clear()
+    report = run_lists(backup_config)
+    assert report["failed_stages"] == []
+    assert len(list_rows(backup_config, 5)) == 20
+    with open(backup_config["BACKUP_FOLDER"]+backup.SYNC_STATE_FILENAME) as f:
+        assert json.load(f)["lists"] > stamp
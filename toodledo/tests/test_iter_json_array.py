@@ -0,0 +1,60 @@
+import json
+import pytest
+from backup import iter_json_array, IncompleteResponseError
+
+
+class FakeResponse:
+    """
+    Streamed response whose body comes in chunks of the given size.
+    """
+    def __init__(self, body, chunk_size):
+        self.body = body.encode("utf-8")
+        self.chunk_size = chunk_size
+
+    def iter_content(self, chunk_size=None):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i:i+self.chunk_size]
+
+
+TASKS = [{"num": 3, "total": 3}, {"id": 1, "title": "Write", "modified": 1700000000},
+         {"id": 22, "title": "", "tag": "a, b"}, {"id": 333, "title": "[not] {the end}", "note": "\"quoted\""}]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 16, 1024])
+def test_elements_across_chunk_boundaries(chunk_size):
+    body = json.dumps(TASKS)
+    assert list(iter_json_array(FakeResponse(body, chunk_size))) == TASKS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5])
+def test_number_cut_at_the_chunk_end(chunk_size):
+    assert list(iter_json_array(FakeResponse("[1, 12345, 678]", chunk_size))) == [1, 12345, 678]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4])
+def test_multibyte_characters_split_across_chunks(chunk_size):
+    items = [{"id": 1, "title": "Größe – 日本語 😀"}, {"id": 2, "title": "ёжик"}]
+    body = json.dumps(items, ensure_ascii=False)
+    assert list(iter_json_array(FakeResponse(body, chunk_size))) == items
+
+
+def test_whitespace_and_empty_array():
+    assert list(iter_json_array(FakeResponse(" \n[ ]\n", 1))) == []
+    assert list(iter_json_array(FakeResponse("[\n  {\"id\": 1} ,\n  {\"id\": 2}\n]", 4))) == [{"id": 1}, {"id": 2}]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1024])
+def test_error_object(chunk_size):
+    body = json.dumps({"errorCode": 2, "errorDesc": "Unauthorized"})
+    with pytest.raises(ValueError) as e:
+        list(iter_json_array(FakeResponse(body, chunk_size)))
+    # The whole error object is in the message
+    assert "Unauthorized" in str(e.value) and str(e.value).endswith(body)
+    assert not isinstance(e.value, IncompleteResponseError)
+
+
+@pytest.mark.parametrize("body", ["", "[", "[{\"id\": 1}, ", "[{\"id\": 1}, {\"id\""])
+def test_cut_body(body):
+    # Retried by the paged fetch, unlike an error object
+    with pytest.raises(IncompleteResponseError):
+        list(iter_json_array(FakeResponse(body, 3)))
@@ -0,0 +1,24 @@
+import backup
+import client
+import storage
+
+
+def test_cut_pages_are_fetched_again(mock_api, backup_config, monkeypatch):
+    monkeypatch.setattr(client, "get_backoff", lambda attempt: 0)
+    backup_config["MAX_RETRIES"] = 3
+    backup_config["TASKS_PAGE_SIZE"] = 500
+    mock_api.cut_responses["tasks/get.php"] = 3
+    report = backup.run_backup(backup_config, backup_config["TOKEN_FILE"], interactive=False, entities=["tasks"])
+    assert report["failed_stages"] == []
+    assert report["retries"]["tasks/get.php"] == 3
+    tasks = storage.read_table(backup_config["BACKUP_FOLDER"]+"raw_tasks.csv")
+    assert len(tasks) == 2000 and tasks["id"].is_unique
+
+
+def test_page_cut_too_often_fails_the_stage(mock_api, backup_config, monkeypatch):
+    monkeypatch.setattr(client, "get_backoff", lambda attempt: 0)
+    backup_config["MAX_RETRIES"] = 1
+    mock_api.cut_responses["notes/get.php"] = 2
+    report = backup.run_backup(backup_config, backup_config["TOKEN_FILE"], interactive=False, entities=["notes"])
+    assert report["failed_stages"] == ["notes"]
+    assert not storage.table_exists(backup_config["BACKUP_FOLDER"]+"notes.csv")
@@ -0,0 +1,19 @@
+import backup
+import storage
+
+
+def test_failed_fetch_keeps_the_previous_table(mock_api, backup_config):
+    backup.run_backup(backup_config, backup_config["TOKEN_FILE"], interactive=False,
+                      entities=["tasks"]+backup.REFERENCE_TABLES)
+    folders = storage.read_table(backup_config["BACKUP_FOLDER"]+"folders.csv")
+    assert len(folders) == mock_api.account.folders
+
+    # A new folder moves the stamp, so the cached table is stale, and it cannot be fetched
+    mock_api.account.folders += 1
+    mock_api.failing_endpoints.add("folders/get.php")
+    report = backup.run_backup(backup_config, backup_config["TOKEN_FILE"], interactive=False,
+                               entities=["folders"])
+    assert report["failed_stages"] == ["folders"]
+    assert storage.read_table(backup_config["BACKUP_FOLDER"]+"folders.csv").equals(folders)
+    tasks = storage.read_table(backup_config["BACKUP_FOLDER"]+"tasks.csv")
+    assert tasks["folder_name"].notna().all()
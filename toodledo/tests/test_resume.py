@@ -0,0 +1,32 @@
+import pytest
+import backup
+import storage
+
+
+def run_tasks(config):
+    return backup.run_backup(config, config["TOKEN_FILE"], interactive=False, entities=["tasks"])
+
+
+def test_resume_after_a_failed_stage(mock_api, backup_config, monkeypatch):
+    run_tasks(backup_config)
+    raw_tasks_filename = backup_config["BACKUP_FOLDER"]+"raw_tasks.csv"
+    assert len(storage.read_table(raw_tasks_filename)) == 2000
+
+    # The tasks cannot be fetched, the previous ones stay; then the run is killed in the merge
+    mock_api.account.tasks = 2500
+    mock_api.failing_endpoints.add("tasks/get.php")
+
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt()
+    with monkeypatch.context() as m:
+        m.setattr(backup, "merge_tasks", crash)
+        with pytest.raises(KeyboardInterrupt):
+            run_tasks(backup_config)
+    assert len(storage.read_table(raw_tasks_filename)) == 2000
+
+    # The resumed run fetches the tasks again instead of taking the stale ones
+    mock_api.failing_endpoints.clear()
+    report = run_tasks(backup_config)
+    assert report["failed_stages"] == []
+    assert len(storage.read_table(raw_tasks_filename)) == 2500
+    assert len(storage.read_table(backup_config["BACKUP_FOLDER"]+"tasks.csv")) == 2500